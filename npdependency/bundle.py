@@ -0,0 +1,133 @@
+"""Single-file model bundles.
+
+A bundle holds everything `BiAffineParser.from_config` needs: the hyperparameters, the
+vocabularies, the FastText subword parameters and the weights. Its layout is
+
+- the magic bytes `MAGIC`
+- the size of the header as an 8 bytes little-endian unsigned integer
+- the header, in JSON
+- padding up to a multiple of `PAGE_SIZE`
+- the weight tensors, each aligned on `TENSOR_ALIGNMENT` bytes
+
+so that the tensors can be memory-mapped instead of read: opening a bundle is almost free and
+the processes that use the same bundle share its pages.
+"""
+import json
+import os
+import pathlib
+from typing import Any, BinaryIO, Dict, Tuple, Union
+
+import numpy as np
+import torch
+
+MAGIC = b"NPDBUNDL"
+FORMAT_VERSION = 1
+PAGE_SIZE = 4096
+TENSOR_ALIGNMENT = 64
+
+
+def _padding(position: int, alignment: int) -> int:
+    return -position % alignment
+
+
+def is_bundle(path: Union[str, pathlib.Path]) -> bool:
+    """Return true if `path` is a bundle (and not e.g. a configuration file)."""
+    try:
+        with open(path, "rb") as in_stream:
+            return in_stream.read(len(MAGIC)) == MAGIC
+    except IsADirectoryError:
+        return False
+
+
+def save_bundle(
+    path: Union[str, pathlib.Path],
+    metadata: Dict[str, Any],
+    state_dict: Dict[str, torch.Tensor],
+):
+    """Write a bundle, `metadata` is saved in the header and must be serializable in JSON.
+
+    The bundle is written atomically.
+    """
+    arrays = {
+        name: tensor.detach().cpu().contiguous().numpy()
+        for name, tensor in state_dict.items()
+    }
+    tensors_index = dict()
+    offset = 0
+    for name, array in arrays.items():
+        offset += _padding(offset, TENSOR_ALIGNMENT)
+        tensors_index[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += array.nbytes
+    header = json.dumps(
+        {
+            "format_version": FORMAT_VERSION,
+            "metadata": metadata,
+            "tensors": tensors_index,
+        }
+    ).encode("utf-8")
+
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as out_stream:
+            out_stream.write(MAGIC)
+            out_stream.write(len(header).to_bytes(8, "little"))
+            out_stream.write(header)
+            _write_padding(out_stream, PAGE_SIZE)
+            data_start = out_stream.tell()
+            for name, array in arrays.items():
+                _write_padding(out_stream, TENSOR_ALIGNMENT, data_start)
+                assert out_stream.tell() - data_start == tensors_index[name]["offset"]
+                out_stream.write(array.data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _write_padding(out_stream: BinaryIO, alignment: int, start: int = 0):
+    out_stream.write(b"\0" * _padding(out_stream.tell() - start, alignment))
+
+
+def _read_header(path: Union[str, pathlib.Path]) -> Tuple[Dict[str, Any], int]:
+    """Return the header of a bundle and the position of its tensors."""
+    with open(path, "rb") as in_stream:
+        if in_stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a model bundle")
+        header_size = int.from_bytes(in_stream.read(8), "little")
+        header = json.loads(in_stream.read(header_size))
+    if header["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported bundle version {header['format_version']}")
+    header_end = len(MAGIC) + 8 + header_size
+    return header, header_end + _padding(header_end, PAGE_SIZE)
+
+
+def read_metadata(path: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    """Return the metadata of a bundle, without opening its tensors."""
+    return _read_header(path)[0]["metadata"]
+
+
+def load_bundle(
+    path: Union[str, pathlib.Path]
+) -> Tuple[Dict[str, Any], Dict[str, torch.Tensor]]:
+    """Open a bundle and return its metadata and its tensors.
+
+    The tensors are copy-on-write memory maps of the bundle: nothing is read before they are
+    used, their pages are shared with the other processes that map the same bundle and the
+    bundle itself is never modified.
+    """
+    header, data_start = _read_header(path)
+    tensors = dict()
+    if header["tensors"]:
+        data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start)
+        for name, index in header["tensors"].items():
+            dtype = np.dtype(index["dtype"])
+            shape = index["shape"]
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            array = data[index["offset"] : index["offset"] + nbytes]
+            tensors[name] = torch.from_numpy(array.view(dtype).reshape(shape))
+    return header["metadata"], tensors
@@ -0,0 +1,120 @@
+"""Full training checkpoints.
+
+A checkpoint holds everything `BiAffineParser.train_model` needs to continue a training exactly
+where it stopped: the weights, the states of the optimizer, of the LR scheduler and of the
+random number generators (of every process for a distributed training), the progress of the
+training and the order of the batches of the current epoch.
+
+Checkpoints are written by an `AsyncCheckpointWriter`, which copies the state on CPU and then
+saves it in a background thread, so that training only waits for the copy.
+"""
+import os
+import pathlib
+import random
+import threading
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+import torch
+
+# 2: the random states and the loss of the epoch are saved for every training process
+FORMAT_VERSION = 2
+
+
+def snapshot(state: Any) -> Any:
+    """Return a copy on CPU of the tensors in a (nested) state, e.g. that of `state_dict()`,
+    that is not affected by the later updates of the original tensors."""
+    if isinstance(state, torch.Tensor):
+        if state.device.type == "cpu":
+            return state.detach().clone()
+        return state.detach().cpu()
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_states() -> Dict[str, Any]:
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict[str, Any]):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def save_checkpoint(state: Dict[str, Any], path: Union[str, pathlib.Path]):
+    """Save a checkpoint atomically: `path` is either the previous checkpoint or this one, even
+    if the process is killed while saving."""
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as out_stream:
+            torch.save({"format_version": FORMAT_VERSION, **state}, out_stream)
+            out_stream.flush()
+            os.fsync(out_stream.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    # The tensors are loaded on CPU, the `load_state_dict` of their owners move them
+    state = torch.load(path, map_location="cpu")
+    if state.get("format_version") != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported checkpoint version {state.get('format_version')}"
+        )
+    return state
+
+
+class AsyncCheckpointWriter:
+    """Save checkpoints to `path` in a background thread, one at a time.
+
+    `save` waits for the previous checkpoint to be written, so that at most one copy of the
+    state is held in memory. Exceptions raised while saving are raised again by the next call to
+    `save` or `close`.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = path
+        self._thread: Optional[threading.Thread] = None
+        self._failure: Optional[BaseException] = None
+
+    def _write(self, state: Dict[str, Any]):
+        try:
+            save_checkpoint(state, self.path)
+        except BaseException as e:
+            self._failure = e
+
+    def wait(self):
+        """Wait for the checkpoint being written, if any."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._failure is not None:
+            failure, self._failure = self._failure, None
+            raise failure
+
+    def save(self, state: Dict[str, Any]):
+        """Save a checkpoint of `state`, which can be modified as soon as this returns."""
+        self.wait()
+        self._thread = threading.Thread(
+            target=self._write, args=(snapshot(state),), daemon=False
+        )
+        self._thread.start()
+
+    def close(self):
+        self.wait()
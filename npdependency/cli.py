@@ -0,0 +1,151 @@
+"""The `graph_parser` command.
+
+The command line is parsed before importing the parser, so that e.g. `graph_parser --help` or
+a wrong option don't wait for torch to be imported.
+"""
+import argparse
+import sys
+
+
+def make_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Graph based Attention based dependency parser/tagger"
+    )
+    parser.add_argument(
+        "config_file", metavar="CONFIG_FILE", type=str, help="the configuration file"
+    )
+    parser.add_argument(
+        "--train_file", metavar="TRAIN_FILE", type=str, help="the conll training file"
+    )
+    parser.add_argument(
+        "--dev_file", metavar="DEV_FILE", type=str, help="the conll development file"
+    )
+    parser.add_argument(
+        "--pred_file",
+        metavar="PRED_FILE",
+        type=str,
+        action="append",
+        help="a conll file to parse, a directory of files to parse or a (quoted) glob pattern, can be repeated. Use '-' to parse the standard input and write the parses to the standard output",
+    )
+    parser.add_argument(
+        "--pred_list",
+        metavar="FILE",
+        type=str,
+        help="a file listing the conll files to parse, one per line, use '-' to read the list from the standard input",
+    )
+    parser.add_argument(
+        "--window_size",
+        metavar="N",
+        type=int,
+        default=4096,
+        help="the number of sentences loaded in memory at once when parsing",
+    )
+    parser.add_argument(
+        "--order_by_length",
+        action="store_true",
+        help="batch sentences of similar lengths together when parsing, which is faster but can slightly change the parses",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        # See `graph_parser.MIXED_PRECISION_DTYPES`
+        choices=["bf16", "fp16"],
+        help="run the model in mixed precision for training and parsing (fp16 is only available on GPU). Supersedes configuration if given",
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["dynamic"],
+        help="quantize the model for parsing on CPU, 'dynamic' quantizes the LSTM and linear weights to int8",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="the number of processes parsing in parallel, mostly useful on CPU",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        metavar="N",
+        type=int,
+        help="the number of torch threads of each parsing process (defaults to the number of CPUs divided by the number of workers)",
+    )
+    parser.add_argument(
+        "--out_dir",
+        metavar="OUT_DIR",
+        type=str,
+        help="the path of the output directory (defaults to the config dir)",
+    )
+    parser.add_argument(
+        "--fasttext",
+        metavar="PATH",
+        help="The path to either an existing FastText model or a raw text file to train one. If this option is absent, a model will be trained from the parsing train set.",
+    )
+    parser.add_argument(
+        "--device",
+        metavar="DEVICE",
+        type=str,
+        help="the (torch) device to use for the parser. Supersedes configuration if given",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        metavar="DIR",
+        type=str,
+        help="a directory where the encoded training and development sets are cached across runs",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        metavar="N",
+        type=int,
+        help="save a full training checkpoint in the model directory every N optimizer steps and at the end of each epoch, for --resume",
+    )
+    parser.add_argument(
+        "--nprocs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="the number of processes training in parallel, each on its own GPU on CUDA devices and with its share of the CPUs otherwise",
+    )
+    restart = parser.add_mutually_exclusive_group()
+    restart.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="If a model already exists, restart training from scratch instead of continuing.",
+    )
+    restart.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted training exactly where its last checkpoint was saved (see --checkpoint_every)",
+    )
+
+    return parser
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from npdependency import server
+
+        server.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "bundle":
+        from npdependency import graph_parser
+
+        graph_parser.bundle_main(sys.argv[2:])
+        return
+
+    parser = make_argument_parser()
+    args = parser.parse_args()
+    if args.pred_file is not None and "-" in args.pred_file:
+        if len(args.pred_file) > 1 or args.pred_list is not None:
+            parser.error(
+                "--pred_file - (the standard input) can't be combined with other files to parse"
+            )
+
+    from npdependency import bundle, graph_parser
+
+    if args.train_file and bundle.is_bundle(args.config_file):
+        parser.error("A model bundle can only be used for parsing")
+    graph_parser.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import pathlib
+import random
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Type
+
+import click
+import click_pathlib
+import numpy as np
+import torch
+
+from npdependency.deptree import (
+    CompactDepGraph,
+    DependencyBatch,
+    DependencyDataset,
+    DepGraph,
+)
+from npdependency.graph_parser import BiAffineParser, load_hyperparameters
+from npdependency.lexers import FastTextDataSet
+
+
+class _SkippedCodes:
+    """Stands for the char and FastText datasets when encoding without their codes."""
+
+    def word2charcodes(self, word: str) -> List[int]:
+        return []
+
+    def word2subcodes(self, word: str) -> np.ndarray:
+        return np.empty(0, dtype=np.int64)
+
+
+class OnTheFlyDataset(DependencyDataset):
+    """A `DependencyDataset` that computes the char and FastText subword codes of every batch
+    when making it, as before they were precomputed by `encode`."""
+
+    def encode(self):
+        char_dataset, ft_dataset = self.char_dataset, self.ft_dataset
+        self.char_dataset, self.ft_dataset = _SkippedCodes(), _SkippedCodes()  # type: ignore
+        try:
+            super().encode()
+        finally:
+            self.char_dataset, self.ft_dataset = char_dataset, ft_dataset
+
+    def pad_token_columns(self, *args, **kwargs) -> Tuple[torch.Tensor, ...]:
+        return ()
+
+    def make_batch(self, batch_indices: Sequence[int]) -> DependencyBatch:
+        batch = super().make_batch(batch_indices)
+        words = [tree.words for tree in batch.trees]
+        return batch._replace(
+            chars=tuple(self.char_dataset.batch_chars(words)),
+            subwords=tuple(self.ft_dataset.batch_sentences(words)),
+        )
+
+
+def check_same_batches(
+    batches: Sequence[DependencyBatch], reference: Sequence[DependencyBatch]
+):
+    """Raise an `AssertionError` if the char or subword codes of the batches differ."""
+    assert len(batches) == len(reference), f"{len(batches)} != {len(reference)} batches"
+    for i, (batch, reference_batch) in enumerate(zip(batches, reference)):
+        for attribute in ("chars", "subwords"):
+            columns, reference_columns = (
+                getattr(b, attribute) for b in (batch, reference_batch)
+            )
+            assert len(columns) == len(reference_columns) and all(
+                torch.equal(column, reference_column)
+                for column, reference_column in zip(columns, reference_columns)
+            ), f"Batch {i} differs in {attribute}"
+
+
+def timed(function: Callable[[], DependencyDataset]) -> Tuple[DependencyDataset, float]:
+    start = time.perf_counter()
+    res = function()
+    return res, time.perf_counter() - start
+
+
+def epoch_batches(
+    dataset: DependencyDataset, batch_size: int, seed: int
+) -> Tuple[List[DependencyBatch], float]:
+    """The batches of a training epoch, shuffled with `seed`, and the time it took to make them."""
+    random.seed(seed)
+    start = time.perf_counter()
+    batches = list(
+        dataset.make_batches(batch_size, shuffle_batches=True, shuffle_data=True)
+    )
+    return batches, time.perf_counter() - start
+
+
+@click.command()
+@click.argument(
+    "config_file",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.argument(
+    "treebank",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.option("--batch_size", type=int, help="Defaults to the one in the configuration")
+@click.option("--epochs", type=int, default=3, show_default=True)
+def compare_batching(
+    config_file: pathlib.Path,
+    treebank: pathlib.Path,
+    batch_size: Optional[int],
+    epochs: int,
+):
+    """Compare the data preparation times of a training on TREEBANK with the char and FastText
+    subword codes precomputed when encoding and computed for every batch, and check that both
+    give the same batches."""
+    if batch_size is None:
+        batch_size = load_hyperparameters(config_file)["batch_size"]
+    parser = BiAffineParser.from_config(config_file, {"device": "cpu"})
+    ft_dataset = FastTextDataSet(parser.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN])
+    trees = DependencyDataset.read_conll(treebank)
+
+    def encode(dataset_type: Type[DependencyDataset], trees: List[CompactDepGraph]):
+        return dataset_type(
+            trees,
+            parser.lexer,
+            parser.charset,
+            ft_dataset,
+            use_labels=parser.labels,
+            use_tags=parser.tagset,
+        )
+
+    print("codes\tencoding (s)\tbatching (s/epoch)")
+    reference_batches: List[List[DependencyBatch]] = []
+    for name, dataset_type in (
+        ("on the fly", OnTheFlyDataset),
+        ("precomputed", DependencyDataset),
+    ):
+        dataset, encoding_duration = timed(lambda: encode(dataset_type, trees))
+        batching_duration = 0.0
+        for epoch in range(epochs):
+            batches, duration = epoch_batches(dataset, batch_size, seed=epoch)
+            batching_duration += duration
+            if len(reference_batches) < epochs:
+                reference_batches.append(batches)
+            else:
+                check_same_batches(batches, reference_batches[epoch])
+        print(f"{name}\t{encoding_duration:.2f}\t{batching_duration / epochs:.2f}")
+
+
+if __name__ == "__main__":
+    compare_batching()
@@ -0,0 +1,139 @@
+import itertools
+import time
+from typing import Callable, List, Optional
+
+import click
+import torch
+
+from npdependency.graph_parser import BiAffine
+
+
+def einsum_biaffine(
+    h: torch.Tensor, weight: torch.Tensor, d: torch.Tensor, bias: bool
+) -> torch.Tensor:
+    """The straightforward implementation of `BiAffine.forward`, as a reference."""
+    if bias:
+        h = torch.cat((h, torch.ones_like(h[..., :1])), dim=-1)
+        d = torch.cat((d, torch.ones_like(d[..., :1])), dim=-1)
+    return torch.einsum("bxi,oij,byj->boxy", h, weight, d)
+
+
+def assert_close(
+    actual: torch.Tensor, expected: torch.Tensor, tolerance: float, name: str
+):
+    """Check that `actual` and `expected` differ by at most `tolerance` relatively to the
+    largest magnitude in `expected`: the values that are summed differ by their rounding
+    errors, which grow with the magnitude of the sum rather than with that of each value.
+    """
+    scale = expected.abs().max().item()
+    torch.testing.assert_close(
+        actual,
+        expected,
+        rtol=0.0,
+        atol=tolerance * scale,
+        msg=lambda message: f"{name} differ: {message}",
+    )
+
+
+def check_equivalence(
+    biaffine: BiAffine, h: torch.Tensor, d: torch.Tensor, tolerance: float
+):
+    """Compare the scores of `biaffine` and their gradients to those of `einsum_biaffine` and
+    raise an `AssertionError` if they differ."""
+    inputs = [h.detach().requires_grad_(), d.detach().requires_grad_()]
+    scores = biaffine(*inputs)
+    reference_inputs = [t.detach().requires_grad_() for t in (h, d, biaffine.weight)]
+    reference = einsum_biaffine(
+        reference_inputs[0],
+        reference_inputs[2],
+        reference_inputs[1],
+        bias=biaffine.bias,
+    )
+    assert_close(scores, reference, tolerance, "Scores")
+
+    output_grad = torch.randn_like(reference)
+    grads = torch.autograd.grad(scores, [*inputs, biaffine.weight], output_grad)
+    reference_grads = torch.autograd.grad(reference, reference_inputs, output_grad)
+    for name, grad, reference_grad in zip(["h", "d", "weight"], grads, reference_grads):
+        assert_close(grad, reference_grad, tolerance, f"Gradients of {name}")
+
+
+def median_duration(fun: Callable[[], torch.Tensor], repeats: int) -> float:
+    fun()
+    durations: List[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fun()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2]
+
+
+def parse_sizes(ctx, param, value: str) -> List[int]:
+    try:
+        return [int(size) for size in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("must be a comma-separated list of integers")
+
+
+@click.command()
+@click.option("--input_dim", type=int, default=512, show_default=True)
+@click.option(
+    "--labels", type=int, default=40, show_default=True, help="The number of labels"
+)
+@click.option(
+    "--batch_sizes", callback=parse_sizes, default="1,8,32", show_default=True
+)
+@click.option(
+    "--lengths",
+    callback=parse_sizes,
+    default="10,40,80",
+    show_default=True,
+    help="The sentence lengths",
+)
+@click.option("--repeats", type=int, default=10, show_default=True)
+@click.option("--threads", type=int, help="The number of torch threads")
+@click.option("--device", default="cpu", show_default=True)
+@click.option(
+    "--check_only", is_flag=True, help="Only check the equivalence, don't time"
+)
+def compare_biaffine(
+    input_dim: int,
+    labels: int,
+    batch_sizes: List[int],
+    lengths: List[int],
+    repeats: int,
+    threads: Optional[int],
+    device: str,
+    check_only: bool,
+):
+    """Check that `BiAffine` computes the same scores and gradients as the einsum of its
+    definition and compare their speeds for the arc and label scorers."""
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    if not check_only:
+        print("scorer\tbias\tbatch\tlength\teinsum (ms)\tBiAffine (ms)\tspeedup")
+    for output_dim, bias in itertools.product((1, labels), (True, False)):
+        biaffine = BiAffine(input_dim, output_dim, bias=bias).to(device)
+        scorer = "arc" if output_dim == 1 else "label"
+        for batch_size, length in itertools.product(batch_sizes, lengths):
+            h, d = torch.randn(2, batch_size, length, input_dim, device=device)
+            check_equivalence(biaffine, h, d, tolerance=1e-5)
+            if check_only:
+                continue
+            with torch.no_grad():
+                reference_duration = median_duration(
+                    lambda: einsum_biaffine(h, biaffine.weight, d, bias), repeats
+                )
+                duration = median_duration(lambda: biaffine(h, d), repeats)
+            print(
+                f"{scorer}\t{bias}\t{batch_size}\t{length}"
+                f"\t{reference_duration * 1000:.2f}\t{duration * 1000:.2f}"
+                f"\t{reference_duration / duration:.2f}"
+            )
+    if check_only:
+        print("BiAffine matches the reference")
+
+
+if __name__ == "__main__":
+    compare_biaffine()
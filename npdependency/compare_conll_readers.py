@@ -0,0 +1,105 @@
+import itertools
+import pathlib
+import tempfile
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import click
+import click_pathlib
+
+from npdependency.deptree import (
+    CompactDepGraph,
+    DepGraph,
+    read_conll_blocks,
+    read_conll_trees,
+)
+
+
+def read_line_by_line(path: pathlib.Path) -> List[DepGraph]:
+    """The reader that `DependencyDataset.read_conll` used before the bulk one."""
+    with open(path) as in_stream:
+        return list(iter(lambda: DepGraph.read_tree(in_stream), None))
+
+
+def read_bulk(path: pathlib.Path) -> List[CompactDepGraph]:
+    with open(path) as in_stream:
+        return list(read_conll_trees(in_stream))
+
+
+def check_same_trees(trees: Sequence[DepGraph], reference: Sequence[CompactDepGraph]):
+    """Raise an `AssertionError` if the trees differ in the columns that the parser uses."""
+    assert len(trees) == len(reference), f"{len(trees)} != {len(reference)} trees"
+    for i, (tree, reference_tree) in enumerate(zip(trees, reference)):
+        for attribute in ("words", "pos_tags", "oracle_governors", "oracle_labels"):
+            value, reference_value = (
+                getattr(t, attribute) for t in (tree, reference_tree)
+            )
+            if callable(value):
+                value, reference_value = value(), reference_value()
+            assert list(value[1:]) == list(
+                reference_value[1:]
+            ), f"Tree {i} differs in {attribute}"
+
+
+def write_synthetic(treebank: pathlib.Path, n_sentences: int, out_path: pathlib.Path):
+    """Write the first `n_sentences` of the sentences of `treebank` repeated endlessly."""
+    with open(treebank) as in_stream:
+        blocks = list(read_conll_blocks(in_stream))
+    with open(out_path, "w") as out_stream:
+        for block in itertools.islice(itertools.cycle(blocks), n_sentences):
+            out_stream.write(f"{block}\n\n")
+
+
+def timed_read(
+    read: Callable[[], Sequence[Union[DepGraph, CompactDepGraph]]],
+) -> Tuple[int, float]:
+    """The number of trees returned by `read` and the time it took."""
+    start = time.perf_counter()
+    n_trees = len(read())
+    return n_trees, time.perf_counter() - start
+
+
+@click.command()
+@click.argument(
+    "treebank",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.option(
+    "--synthetic_sentences",
+    type=int,
+    default=100000,
+    show_default=True,
+    help="The size of a synthetic treebank made of the sentences of TREEBANK, 0 to skip it",
+)
+@click.option(
+    "--tmp_dir",
+    type=click_pathlib.Path(file_okay=False),
+    help="Where to write the synthetic treebank",
+)
+def compare_conll_readers(
+    treebank: pathlib.Path,
+    synthetic_sentences: int,
+    tmp_dir: Optional[pathlib.Path],
+):
+    """Check that the bulk CoNLL-U reader reads the same trees as the line by line
+    `DepGraph.read_tree` and compare their speeds on TREEBANK and on a larger synthetic
+    treebank."""
+    check_same_trees(read_line_by_line(treebank), read_bulk(treebank))
+    print("file\tsentences\tline by line (s)\tbulk (s)\tspeedup")
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        paths = [treebank]
+        if synthetic_sentences:
+            synthetic_path = pathlib.Path(tmp) / f"synthetic-{treebank.name}"
+            write_synthetic(treebank, synthetic_sentences, synthetic_path)
+            paths.append(synthetic_path)
+        for path in paths:
+            n_trees, line_by_line_duration = timed_read(lambda: read_line_by_line(path))
+            _, bulk_duration = timed_read(lambda: read_bulk(path))
+            print(
+                f"{path.name}\t{n_trees}\t{line_by_line_duration:.2f}"
+                f"\t{bulk_duration:.2f}\t{line_by_line_duration / bulk_duration:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    compare_conll_readers()
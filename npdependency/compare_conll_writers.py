@@ -0,0 +1,70 @@
+import io
+import pathlib
+import time
+from typing import Callable, List, Sequence, TextIO
+
+import click
+import click_pathlib
+
+from npdependency.deptree import CompactDepGraph, read_conll_trees, write_conll
+
+
+def write_with_str(trees: Sequence[CompactDepGraph], ostream: TextIO):
+    """The writer that the parser used before `write_conll`: `str` of the rich trees."""
+    for tree in trees:
+        print(str(tree.to_depgraph()), file=ostream, end="\n\n")
+
+
+def check_same_output(trees: Sequence[CompactDepGraph]):
+    """Raise an `AssertionError` if the writers don't give byte-identical outputs."""
+    outputs = []
+    for write in (write_with_str, write_conll):
+        ostream = io.StringIO()
+        write(trees, ostream)
+        outputs.append(ostream.getvalue().encode("utf-8"))
+    assert outputs[0] == outputs[1], "The outputs of the writers differ"
+
+
+def timed_write(
+    write: Callable[[Sequence[CompactDepGraph], TextIO], None],
+    trees: Sequence[CompactDepGraph],
+) -> float:
+    """The time it takes `write` to serialize `trees` in memory."""
+    ostream = io.StringIO()
+    start = time.perf_counter()
+    write(trees, ostream)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.argument(
+    "treebank",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.option(
+    "--repeat",
+    type=int,
+    default=50,
+    show_default=True,
+    help="The number of copies of the trees of TREEBANK in the larger synthetic treebank",
+)
+def compare_conll_writers(treebank: pathlib.Path, repeat: int):
+    """Check that `write_conll` writes the same bytes as the `str` of the trees and compare their
+    speeds on TREEBANK and on TREEBANK repeated several times."""
+    with open(treebank) as in_stream:
+        trees: List[CompactDepGraph] = list(read_conll_trees(in_stream))
+    check_same_output(trees)
+    print("trees\ttokens\tstr (s)\twrite_conll (s)\tspeedup")
+    for copies in (1, repeat):
+        sample = trees * copies
+        n_tokens = sum(len(tree) - 1 for tree in sample)
+        str_duration = timed_write(write_with_str, sample)
+        bulk_duration = timed_write(write_conll, sample)
+        print(
+            f"{len(sample)}\t{n_tokens}\t{str_duration:.2f}"
+            f"\t{bulk_duration:.2f}\t{str_duration / bulk_duration:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    compare_conll_writers()
@@ -0,0 +1,77 @@
+import io
+import pathlib
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+import click_pathlib
+import torch
+
+from npdependency import conll2018_eval as evaluator
+from npdependency.deptree import CompactDepGraph, DependencyDataset, write_conll
+from npdependency.graph_parser import BiAffineParser, load_hyperparameters
+
+
+VARIANTS: Dict[str, Dict[str, Any]] = {
+    "fp32": {},
+    "int8-dynamic": {"quantize": "dynamic"},
+}
+
+
+@click.command()
+@click.argument(
+    "config_file",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.argument(
+    "dev_file",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+@click.option("--batch_size", type=int, help="Defaults to the one in the configuration")
+@click.option("--threads", type=int, help="The number of torch threads")
+def compare_quantized(
+    config_file: pathlib.Path,
+    dev_file: pathlib.Path,
+    batch_size: Optional[int],
+    threads: Optional[int],
+):
+    """Compare the accuracy and the speed on CPU of a model and of its quantized versions."""
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if batch_size is None:
+        batch_size = load_hyperparameters(config_file)["batch_size"]
+    trees = DependencyDataset.read_conll(dev_file)
+    gold_conllu = evaluator.load_conllu_file(dev_file)
+
+    print("model\tUPOS\tUAS\tLAS\tsentences/s")
+    for name, overrides in VARIANTS.items():
+        parsed, duration = parse_with(config_file, overrides, trees, batch_size)
+        output = io.StringIO()
+        write_conll(parsed, output)
+        output.seek(0)
+        metrics = evaluator.evaluate(gold_conllu, evaluator.load_conllu(output))
+        print(
+            f"{name}\t{metrics['UPOS'].f1:.4f}\t{metrics['UAS'].f1:.4f}"
+            f"\t{metrics['LAS'].f1:.4f}\t{len(trees) / duration:.1f}"
+        )
+
+
+def parse_with(
+    config_file: pathlib.Path,
+    overrides: Dict[str, Any],
+    trees: List[CompactDepGraph],
+    batch_size: int,
+) -> Tuple[List[CompactDepGraph], float]:
+    """Parse trees on CPU with a model loaded with `overrides` and return the parsed trees and
+    the parsing time. The model is freed on return, so that we never hold two of them."""
+    parser = BiAffineParser.from_config(config_file, {"device": "cpu", **overrides})
+    parser.eval()
+    dataset = parser.encode_trees(trees)
+    parsed: List[CompactDepGraph] = []
+    start = time.perf_counter()
+    parser.parse(dataset, batch_size, parsed.extend, order_by_length=True)
+    return parsed, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    compare_quantized()
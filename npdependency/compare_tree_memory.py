@@ -0,0 +1,55 @@
+import gc
+import pathlib
+import tracemalloc
+from typing import Callable, List, Sequence, Tuple, Union
+
+import click
+import click_pathlib
+
+from npdependency.deptree import CompactDepGraph, DepGraph, read_conll_trees
+
+
+def read_depgraphs(path: pathlib.Path) -> List[DepGraph]:
+    with open(path) as in_stream:
+        return list(iter(lambda: DepGraph.read_tree(in_stream), None))
+
+
+def read_compact(path: pathlib.Path) -> List[CompactDepGraph]:
+    with open(path) as in_stream:
+        return list(read_conll_trees(in_stream))
+
+
+def traced_memory(
+    load: Callable[[], Sequence[Union[DepGraph, CompactDepGraph]]]
+) -> Tuple[int, int]:
+    """The number of trees returned by `load` and the memory that they use, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        trees = load()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return len(trees), size
+
+
+@click.command()
+@click.argument(
+    "treebank",
+    type=click_pathlib.Path(resolve_path=True, exists=True, dir_okay=False),
+)
+def compare_tree_memory(treebank: pathlib.Path):
+    """Compare the memory used by the trees of a treebank read as `DepGraph`s and as
+    `CompactDepGraph`s."""
+    print("representation\ttrees\tMiB\tbytes/tree")
+    for name, load in (
+        ("DepGraph", lambda: read_depgraphs(treebank)),
+        ("CompactDepGraph", lambda: read_compact(treebank)),
+    ):
+        n_trees, size = traced_memory(load)
+        print(f"{name}\t{n_trees}\t{size / 2**20:.1f}\t{size / n_trees:.0f}")
+
+
+if __name__ == "__main__":
+    compare_tree_memory()
@@ -1,6 +1,16 @@
+import hashlib
+import itertools
+import os
 import pathlib
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+from array import array
 from random import shuffle
 from typing import (
+    Collection,
     Dict,
     Iterable,
     List,
@@ -9,16 +19,19 @@ from typing import (
     Sequence,
     Set,
     TextIO,
+    Tuple,
     TypeVar,
     Union,
 )
 
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 from typing_extensions import Final
 
 from npdependency import lexers
-from npdependency.lexers import BertLexerBatch, BertLexerSentence
+from npdependency.lexers import BertLexerBatch, BertLexerSentence, TokenSpan
+from npdependency.mst import chuliu_edmonds_one_root as chuliu_edmonds
 
 
 class MWERange(NamedTuple):
@@ -246,7 +259,7 @@ class DepGraph:
         """
         Conll string for the dep tree
         """
-        lines = self.metadata
+        lines = list(self.metadata)
         revdeps = {edge.dep: (edge.label, edge.gov) for edge in self.get_all_edges()}
         for node_idx, form in enumerate(self.words[1:], start=1):
             dataline = ["_"] * 10
@@ -267,6 +280,292 @@ class DepGraph:
         return len(self.words)
 
 
+class CompactDepGraph:
+    """A compact, read-only dependency tree.
+
+    This is the representation used for storing treebanks in memory: every token stores exactly one
+    governor, so the heads are held in a flat integer array and the forms, tags and labels are
+    interned strings shared across all the trees of a treebank. Node `0` is the root, which means
+    that `heads[i]` and `labels[i]` are the governor and the dependency label of the `i`-th word.
+
+    `DepGraph` remains the rich representation (arbitrary arcs, cycle checks…), use
+    `from_depgraph` and `to_depgraph` to convert between them.
+    """
+
+    __slots__ = ("words", "pos_tags", "heads", "labels", "mwe_ranges", "metadata")
+
+    def __init__(
+        self,
+        words: Sequence[str],
+        heads: Iterable[int],
+        labels: Sequence[str],
+        pos_tags: Optional[Sequence[str]] = None,
+        mwe_ranges: Optional[Iterable[MWERange]] = None,
+        metadata: Optional[Iterable[str]] = None,
+    ):
+        """
+        `words`, `heads`, `labels` and `pos_tags` include the root node at index `0`.
+        """
+        self.words: Tuple[str, ...] = tuple(map(sys.intern, words))
+        self.heads = array("i", heads)
+        self.labels: Tuple[str, ...] = tuple(map(sys.intern, labels))
+        self.pos_tags: Tuple[str, ...] = tuple(
+            map(sys.intern, pos_tags if pos_tags is not None else [])
+        )
+        self.mwe_ranges: Tuple[MWERange, ...] = (
+            tuple(mwe_ranges) if mwe_ranges is not None else ()
+        )
+        self.metadata: Tuple[str, ...] = tuple(metadata) if metadata is not None else ()
+        if len(self.heads) != len(self.words) or len(self.labels) != len(self.words):
+            raise ValueError(
+                f"Inconsistent tree: {len(self.words)} words,"
+                f" {len(self.heads)} heads and {len(self.labels)} labels"
+            )
+
+    @classmethod
+    def from_depgraph(cls, graph: DepGraph) -> "CompactDepGraph":
+        return cls(
+            words=graph.words,
+            heads=graph.oracle_governors(),
+            labels=graph.oracle_labels(),
+            pos_tags=graph.pos_tags,
+            mwe_ranges=graph.mwe_ranges,
+            metadata=graph.metadata,
+        )
+
+    @classmethod
+    def from_conll(cls, lines: Sequence[str]) -> Optional["CompactDepGraph"]:
+        """
+        Builds a tree from the lines of a conll block, reading only the ID, FORM, UPOS, HEAD and
+        DEPREL columns. Missing heads (truncated lines) are attached to the root and empty nodes
+        are ignored. Returns `None` if the block has no word.
+        """
+        metadata = [line.strip() for line in lines if line.startswith("#")]
+        if metadata:
+            lines = [line for line in lines if not line.startswith("#")]
+        mwe_ranges: List[MWERange] = []
+
+        # We never need the columns after DEPREL, so they are not split
+        rows = [line.split("\t", 8) for line in lines]
+        columns = list(zip(*rows))
+        # Fast path for complete blocks without multi-word tokens nor empty nodes: read the
+        # transposed block column-wise
+        if len(columns) == 9 and "".join(columns[0]).isdigit():
+            words = columns[1]
+            tags = columns[3]
+            heads = [int(head) for head in columns[6]]
+            labels = [
+                "root" if head == 0 else label
+                for head, label in zip(heads, columns[7])
+            ]
+        else:
+            rows = [line.strip().split("\t") for line in lines]
+            for row in rows:
+                if "-" in row[0]:
+                    mwe_start, mwe_end = row[0].split("-")
+                    mwe_ranges.append(MWERange(int(mwe_start), int(mwe_end), row[1]))
+            rows = [row for row in rows if row[0].isdigit()]
+            words = [row[1] for row in rows]
+            tags = [row[3] if len(row) > 3 else "_" for row in rows]
+            heads = [int(row[6]) if len(row) > 7 else 0 for row in rows]
+            labels = [
+                row[7] if len(row) > 7 and head != 0 else "root"
+                for row, head in zip(rows, heads)
+            ]
+        if not words:
+            return None
+        # Same rule as `DepGraph.add_root`: the root is the only governor without a governor
+        dependents = {dep for dep, head in enumerate(heads, start=1) if head != 0}
+        if dependents:
+            roots = {heads[dep - 1] for dep in dependents}.difference(dependents)
+            if len(roots) > 1:
+                raise ValueError("Malformed tree: multiple roots")
+            elif not roots:
+                raise ValueError("Malformed tree: no root")
+        return cls(
+            [DepGraph.ROOT_TOKEN, *words],
+            [0, *heads],
+            ["_", *labels],
+            pos_tags=[
+                DepGraph.ROOT_TOKEN,
+                *(tag for tag in tags if tag not in ("-", "_")),
+            ],
+            mwe_ranges=mwe_ranges,
+            metadata=metadata,
+        )
+
+    def to_depgraph(self) -> DepGraph:
+        return DepGraph(
+            self.get_all_edges(),
+            wordlist=self.words[1:],
+            pos_tags=self.pos_tags[1:],
+            mwe_ranges=list(self.mwe_ranges),
+            metadata=list(self.metadata),
+        )
+
+    def get_all_edges(self) -> List[Edge]:
+        """
+        Returns the list of edges found in this tree
+        """
+        return [
+            Edge(self.heads[dep], self.labels[dep], dep) for dep in range(1, len(self))
+        ]
+
+    def get_all_labels(self) -> List[str]:
+        """
+        Returns the list of dependency labels found on the arcs
+        """
+        return list(self.labels[1:])
+
+    def oracle_governors(self) -> List[int]:
+        """
+        Returns a list where each element list[i] is the index of
+        the position of the governor of the word at position i.
+        """
+        return self.heads.tolist()
+
+    def oracle_labels(self) -> List[str]:
+        """
+        Returns a list where each element list[i] is the label of
+        the position of the governor of the word at position i.
+        """
+        return list(self.labels)
+
+    def to_conll(self, columns: Optional[Collection[str]] = None) -> str:
+        """
+        Conll string for the tree. If `columns` is given, only these columns (see
+        `CONLL_COLUMNS`) are filled, the others are written as `_`. The ID column is always
+        written.
+        """
+        if columns is None:
+            columns = _DEFAULT_CONLL_COLUMNS
+        else:
+            unknown = set(columns).difference(CONLL_COLUMNS)
+            if unknown:
+                raise ValueError(f"Unknown CoNLL-U columns: {sorted(unknown)}")
+        fields: Dict[str, Iterable] = {"ID": range(1, len(self.words))}
+        if "FORM" in columns:
+            fields["FORM"] = self.words[1:]
+        if "UPOS" in columns and len(self.pos_tags) == len(self.words):
+            fields["UPOS"] = self.pos_tags[1:]
+        if "HEAD" in columns:
+            fields["HEAD"] = self.heads[1:]
+        if "DEPREL" in columns:
+            fields["DEPREL"] = self.labels[1:]
+        template = "\t".join(
+            "{}" if column in fields else "_" for column in CONLL_COLUMNS
+        )
+        lines: Iterable[str] = map(
+            template.format, *(fields[column] for column in CONLL_COLUMNS if column in fields)
+        )
+        if self.mwe_ranges:
+            mwe_lines: Dict[int, List[str]] = dict()
+            for mwe in self.mwe_ranges:
+                mwe_lines.setdefault(mwe.start, []).append(mwe.to_conll())
+            lines = [
+                line
+                for node_idx, token_line in enumerate(lines, start=1)
+                for line in (*mwe_lines.get(node_idx, ()), token_line)
+            ]
+        return "\n".join(itertools.chain(self.metadata, lines))
+
+    def __str__(self):
+        return self.to_conll()
+
+    def __len__(self):
+        return len(self.words)
+
+
+CONLL_COLUMNS: Final = (
+    "ID",
+    "FORM",
+    "LEMMA",
+    "UPOS",
+    "XPOS",
+    "FEATS",
+    "HEAD",
+    "DEPREL",
+    "DEPS",
+    "MISC",
+)
+# The columns that `CompactDepGraph` stores
+_DEFAULT_CONLL_COLUMNS: Final = frozenset(("FORM", "UPOS", "HEAD", "DEPREL"))
+
+
+def write_conll(
+    trees: Iterable[CompactDepGraph],
+    ostream: TextIO,
+    columns: Optional[Collection[str]] = None,
+):
+    """Write trees to `ostream` in CoNLL-U format, with one write per call.
+
+    See `CompactDepGraph.to_conll` for `columns`.
+    """
+    ostream.write("".join(f"{tree.to_conll(columns)}\n\n" for tree in trees))
+
+
+def parsed_output_paths(
+    pred_files: Iterable[str], out_dir: Optional[str] = None
+) -> List[Tuple[str, str]]:
+    """
+    Returns the pairs of the files to parse and of the files where their parses are written:
+    `FILE.parsed` in `out_dir` if it is given, next to `FILE` otherwise. A file given several
+    times is only parsed once. Raises a `ValueError` if several files would be parsed to the
+    same path, e.g. files with the same name in different directories and an `out_dir`.
+    """
+    res: Dict[str, Tuple[str, str]] = dict()
+    sources: Dict[str, str] = dict()
+    for pred_file in pred_files:
+        if os.path.realpath(pred_file) in res:
+            continue
+        out_file = os.path.join(
+            out_dir if out_dir is not None else os.path.dirname(pred_file),
+            f"{os.path.basename(pred_file)}.parsed",
+        )
+        other_file = sources.setdefault(os.path.realpath(out_file), pred_file)
+        if other_file != pred_file:
+            raise ValueError(
+                f"{other_file} and {pred_file} would both be parsed to {out_file}"
+            )
+        res[os.path.realpath(pred_file)] = (pred_file, out_file)
+    return list(res.values())
+
+
+_BLOCK_SEPARATOR = re.compile(r"\n\s*\n")
+
+
+def read_conll_blocks(istream: TextIO, chunk_size: int = 2 ** 20) -> Iterable[str]:
+    """
+    Yields the raw conll blocks (one per sentence) of a stream, reading it by chunks of
+    `chunk_size` characters instead of line by line.
+    """
+    remainder = ""
+    while True:
+        chunk = istream.read(chunk_size)
+        if not chunk:
+            break
+        blocks = _BLOCK_SEPARATOR.split(remainder + chunk)
+        # The last block might continue in the next chunk
+        remainder = blocks.pop()
+        for block in blocks:
+            if block and not block.isspace():
+                yield block.strip("\n")
+    if remainder and not remainder.isspace():
+        yield remainder.strip("\n")
+
+
+def read_conll_trees(
+    istream: TextIO, chunk_size: int = 2 ** 20
+) -> Iterable[CompactDepGraph]:
+    """
+    Lazily reads the trees of a conll stream.
+    """
+    for block in read_conll_blocks(istream, chunk_size=chunk_size):
+        tree = CompactDepGraph.from_conll(block.split("\n"))
+        if tree is not None:
+            yield tree
+
+
 T = TypeVar("T", bound="DependencyBatch")
 
 
@@ -275,7 +574,7 @@ class DependencyBatch(NamedTuple):
 
     ## Attributes
 
-    - `trees` The sentences as `DepGraph`s for rich attribute access.
+    - `trees` The sentences as `CompactDepGraph`s for rich attribute access.
     - `chars` Encoded chars as a sequence of `LongTensor`. `chars[i][j, k]` is the k-th character of
       the i-th word of the j-th sentence in the batch.
     - `subwords` Encoded FastText subwords as a sequence of `LongTensor`. As with `chars`,
@@ -296,7 +595,7 @@ class DependencyBatch(NamedTuple):
       padding not the root (i.e. iff `1 <= j < sent_length[i]`).
     """
 
-    trees: Sequence[DepGraph]
+    trees: Sequence[CompactDepGraph]
     chars: Sequence[torch.Tensor]
     subwords: Sequence[torch.Tensor]
     encoded_words: Union[torch.Tensor, BertLexerBatch]
@@ -306,22 +605,85 @@ class DependencyBatch(NamedTuple):
     sent_lengths: torch.Tensor
     content_mask: torch.Tensor
 
-    def to(self: T, device: Union[str, torch.device]) -> T:
-        encoded_words = self.encoded_words.to(device)
-        chars = [token.to(device) for token in self.chars]
-        subwords = [token.to(device) for token in self.subwords]
+    def to(self: T, device: Union[str, torch.device], non_blocking: bool = False) -> T:
+        encoded_words = self.encoded_words.to(device, non_blocking=non_blocking)
+        chars = [token.to(device, non_blocking=non_blocking) for token in self.chars]
+        subwords = [
+            token.to(device, non_blocking=non_blocking) for token in self.subwords
+        ]
         return type(self)(
             trees=self.trees,
             chars=chars,
             subwords=subwords,
             encoded_words=encoded_words,
-            tags=self.tags.to(device),
-            heads=self.heads.to(device),
-            labels=self.labels.to(device),
+            tags=self.tags.to(device, non_blocking=non_blocking),
+            heads=self.heads.to(device, non_blocking=non_blocking),
+            labels=self.labels.to(device, non_blocking=non_blocking),
+            sent_lengths=self.sent_lengths,
+            content_mask=self.content_mask.to(device, non_blocking=non_blocking),
+        )
+
+    def pin_memory(self: T) -> T:
+        """Copy the tensors of this batch to pinned memory for faster and asynchronous transfers
+        to CUDA devices. `sent_lengths` stays in pageable memory since it is only used on CPU."""
+        return type(self)(
+            trees=self.trees,
+            chars=[token.pin_memory() for token in self.chars],
+            subwords=[token.pin_memory() for token in self.subwords],
+            encoded_words=self.encoded_words.pin_memory(),
+            tags=self.tags.pin_memory(),
+            heads=self.heads.pin_memory(),
+            labels=self.labels.pin_memory(),
             sent_lengths=self.sent_lengths,
-            content_mask=self.content_mask.to(device),
+            content_mask=self.content_mask.pin_memory(),
         )
 
+    def parsed_trees(
+        self,
+        tag_ids: np.ndarray,
+        arc_scores: np.ndarray,
+        best_labels: np.ndarray,
+        itolab: Sequence[str],
+        itotag: Sequence[str],
+        greedy: bool = False,
+    ) -> List[CompactDepGraph]:
+        """
+        Decode the outputs of a parser for this batch: `tag_ids` has the shape of `heads`,
+        `arc_scores[i, h, d]` is the score of the arc from `h` to `d` in the i-th sentence and
+        `best_labels[i, h, d]` is the best label for this arc.
+
+        The heads are the maximum spanning trees of the arc scores (or their argmax if `greedy`).
+        """
+        lengths = self.sent_lengths.tolist()
+        # Predict heads, this is the only step that has to be done sentence by sentence
+        heads = np.zeros(tag_ids.shape, dtype=np.int64)
+        for i, length in enumerate(lengths):
+            probs = arc_scores[i, :length, :length].T
+            heads[i, :length] = (
+                np.argmax(probs, axis=1) if greedy else chuliu_edmonds(probs)
+            )
+        # Predict labels: the best label of the predicted arcs
+        labels = np.take_along_axis(
+            best_labels, heads[:, np.newaxis, :], axis=1
+        ).squeeze(1)
+
+        return [
+            CompactDepGraph(
+                tree.words,
+                [0, *sent_heads[1:length]],
+                ["_", *(itolab[label] for label in sent_labels[1:length])],
+                pos_tags=[
+                    DepGraph.ROOT_TOKEN,
+                    *(itotag[tag] for tag in sent_tags[1:length]),
+                ],
+                mwe_ranges=tree.mwe_ranges,
+                metadata=tree.metadata,
+            )
+            for tree, length, sent_heads, sent_labels, sent_tags in zip(
+                self.trees, lengths, heads.tolist(), labels.tolist(), tag_ids.tolist()
+            )
+        ]
+
 
 class DependencyDataset:
     """
@@ -334,34 +696,72 @@ class DependencyDataset:
     UNK_WORD: Final[str] = "<unk>"
     # Labels that are -100 are ignored in torch crossentropy
     LABEL_PADDING: Final[int] = -100
+    # The version of the format of the caches written by `save_encoded`, to be changed with
+    # `encode` and `ENCODED_ARRAYS`
+    CACHE_VERSION: Final[int] = 1
+    # The flat arrays that make an encoded dataset, see `encode`
+    ENCODED_ARRAYS: Final[Tuple[str, ...]] = (
+        "sent_offsets",
+        "word_indices",
+        "heads",
+        "labels",
+        "tags",
+        "char_offsets",
+        "chars",
+        "subword_offsets",
+        "subwords",
+        "bert_offsets",
+        "bert_input_ids",
+        "bert_alignments",
+    )
 
-    @staticmethod
+    @classmethod
     def read_conll(
-        filename: Union[str, pathlib.Path], max_tree_length: Optional[int] = None
-    ) -> List[DepGraph]:
+        cls,
+        filename: Union[str, pathlib.Path],
+        max_tree_length: Optional[int] = None,
+        cache_path: Optional[Union[str, pathlib.Path]] = None,
+    ) -> List[CompactDepGraph]:
+        """
+        If `cache_path` is a valid cache of the encoded treebank (see `save_encoded`), the trees
+        are loaded from there instead of parsing `filename`.
+        """
+        if cache_path is not None:
+            try:
+                treelist = cls.load_cached_trees(cache_path)
+            except ValueError:
+                pass
+            else:
+                print(f"Loading the trees of {filename} from {cache_path}")
+                return treelist
         print(f"Reading treebank from {filename}")
         with open(filename) as istream:
             treelist = []
-            tree = DepGraph.read_tree(istream)
-            while tree:
+            for tree in read_conll_trees(istream):
                 if max_tree_length is None or len(tree.words) <= max_tree_length:
                     treelist.append(tree)
                 else:
                     print(
                         f"Dropped tree with length {len(tree.words)} > {max_tree_length}",
                     )
-                tree = DepGraph.read_tree(istream)
         return treelist
 
     def __init__(
         self,
-        treelist: List[DepGraph],
+        treelist: List[CompactDepGraph],
         lexer: lexers.Lexer,
         char_dataset: lexers.CharDataSet,
         ft_dataset: lexers.FastTextDataSet,
         use_labels: Optional[List[str]] = None,
         use_tags: Optional[List[str]] = None,
+        cache_path: Optional[Union[str, pathlib.Path]] = None,
     ):
+        """
+        If `cache_path` is given, the encoded dataset is read from there if it exists and saved
+        there otherwise, or if it is not a valid cache of the current `CACHE_VERSION`. The cache
+        is not checked against the trees and the vocabularies: use a path that depends on them,
+        e.g. `dataset_cache_key`.
+        """
         self.lexer = lexer
         self.char_dataset = char_dataset
         self.ft_dataset = ft_dataset
@@ -376,19 +776,78 @@ class DependencyDataset:
             self.tagtoi = {tag: idx for idx, tag in enumerate(self.itotag)}
         else:
             self.init_tags(self.treelist)
-        self.encoded_words: List[Union[List[int], BertLexerSentence]] = []
-        self.heads: List[List[int]] = []
-        self.labels: List[List[int]] = []
-        self.tags: List[List[int]] = []
+
+        # The encoded sentences are concatenated in flat arrays: the features of the i-th
+        # sentence are `array[sent_offsets[i]:sent_offsets[i+1]]`
+        self.sent_offsets: np.ndarray
+        self.word_indices: np.ndarray
+        self.heads: np.ndarray
+        self.labels: np.ndarray
+        self.tags: np.ndarray
+        # The char and fasttext subword codes are concatenated at the token level: the codes of
+        # the j-th token of the i-th sentence are `chars[char_offsets[k]:char_offsets[k+1]]` with
+        # `k = sent_offsets[i]+j`
+        self.char_offsets: np.ndarray
+        self.chars: np.ndarray
+        self.subword_offsets: np.ndarray
+        self.subwords: np.ndarray
+        # Only for BERT lexers: the subwords of the i-th sentence are
+        # `bert_input_ids[bert_offsets[i]:bert_offsets[i+1]]` and the alignments of its words
+        # (without the root) are `bert_alignments[sent_offsets[i]-i:sent_offsets[i+1]-i-1]`
+        self.bert_offsets: Optional[np.ndarray] = None
+        self.bert_input_ids: Optional[np.ndarray] = None
+        self.bert_alignments: Optional[np.ndarray] = None
+
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                self.load_encoded(cache_path)
+            except ValueError as e:
+                print(f"Rebuilding the dataset cache: {e}", file=sys.stderr)
+                shutil.rmtree(cache_path, ignore_errors=True)
+            else:
+                print(f"Loaded encoded dataset from {cache_path}")
+                return
         self.encode()
+        if cache_path is not None:
+            self.save_encoded(cache_path)
 
     def encode(self):
         # NOTE: we mask the ROOT token features with the label padding that will be ignored by
         # crossentropy, it's not very satisfying though, maybe hardcode it in (lab|tag)toi ?
-        self.encoded_words, self.heads, self.labels, self.tags = [], [], [], []
+        sent_offsets = [0]
+        word_indices: List[int] = []
+        heads: List[int] = []
+        labels: List[int] = []
+        tags: List[int] = []
+        char_offsets = [0]
+        chars: List[int] = []
+        subword_offsets = [0]
+        subwords: List[int] = []
+        bert_offsets = [0]
+        bert_input_ids: List[int] = []
+        bert_alignments: List[Tuple[int, int]] = []
 
         for tree in self.treelist:
             encoded_words = self.lexer.tokenize(tree.words)
+            if isinstance(encoded_words, BertLexerSentence):
+                word_indices.extend(encoded_words.word_indices)
+                bert_input_ids.extend(encoded_words.bert_encoding["input_ids"])
+                bert_offsets.append(len(bert_input_ids))
+                # Words that the BERT tokenizer maps to no subword have no alignment
+                bert_alignments.extend(
+                    (-1, -1) if span is None else (span.start, span.end)
+                    for span in encoded_words.subwords_alignments
+                )
+            else:
+                word_indices.extend(encoded_words)
+            sent_offsets.append(len(word_indices))
+
+            for word in tree.words:
+                chars.extend(self.char_dataset.word2charcodes(word))
+                char_offsets.append(len(chars))
+                subwords.extend(self.ft_dataset.word2subcodes(word).tolist())
+                subword_offsets.append(len(subwords))
+
             if tree.pos_tags:
                 deptag_idxes = [
                     self.tagtoi.get(tag, self.tagtoi[self.UNK_WORD])
@@ -397,14 +856,123 @@ class DependencyDataset:
             else:
                 deptag_idxes = [self.tagtoi[self.UNK_WORD] for _ in tree.words]
             deptag_idxes[0] = self.LABEL_PADDING
-            self.tags.append(deptag_idxes)
-            self.encoded_words.append(encoded_words)
-            heads = tree.oracle_governors()
-            heads[0] = self.LABEL_PADDING
-            self.heads.append(heads)
-            labels = [self.labtoi.get(lab, 0) for lab in tree.oracle_labels()]
-            labels[0] = self.LABEL_PADDING
-            self.labels.append(labels)
+            # The sentences with missing tags have fewer tags than words, complete them as
+            # the padding of a batch would, so that the tags stay aligned with `sent_offsets`
+            deptag_idxes.extend(
+                self.LABEL_PADDING for _ in range(len(tree.words) - len(deptag_idxes))
+            )
+            tags.extend(deptag_idxes)
+            sent_heads = tree.oracle_governors()
+            sent_heads[0] = self.LABEL_PADDING
+            heads.extend(sent_heads)
+            sent_labels = [self.labtoi.get(lab, 0) for lab in tree.oracle_labels()]
+            sent_labels[0] = self.LABEL_PADDING
+            labels.extend(sent_labels)
+
+        self.sent_offsets = np.array(sent_offsets, dtype=np.int64)
+        self.word_indices = np.array(word_indices, dtype=np.int64)
+        self.heads = np.array(heads, dtype=np.int64)
+        self.labels = np.array(labels, dtype=np.int64)
+        self.tags = np.array(tags, dtype=np.int64)
+        self.char_offsets = np.array(char_offsets, dtype=np.int64)
+        self.chars = np.array(chars, dtype=np.int64)
+        self.subword_offsets = np.array(subword_offsets, dtype=np.int64)
+        self.subwords = np.array(subwords, dtype=np.int64)
+        if len(bert_offsets) > 1:
+            self.bert_offsets = np.array(bert_offsets, dtype=np.int64)
+            self.bert_input_ids = np.array(bert_input_ids, dtype=np.int64)
+            self.bert_alignments = np.array(bert_alignments, dtype=np.int64).reshape(
+                -1, 2
+            )
+
+    def save_encoded(self, path: Union[str, pathlib.Path]):
+        """
+        Saves the encoded dataset as a directory of flat numpy arrays, along with its trees and
+        the `CACHE_VERSION`. The directory is written atomically, so concurrent runs can safely
+        share a cache.
+        """
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix=f".{path.name}-", dir=path.parent))
+        for name in self.ENCODED_ARRAYS:
+            encoded = getattr(self, name)
+            if encoded is not None:
+                np.save(tmp_dir / f"{name}.npy", encoded)
+        with open(tmp_dir / "trees.pickle", "wb") as ostream:
+            pickle.dump(self.treelist, ostream, protocol=pickle.HIGHEST_PROTOCOL)
+        (tmp_dir / "version").write_text(f"{self.CACHE_VERSION}\n")
+        try:
+            os.rename(tmp_dir, path)
+        except OSError:
+            # Another process wrote the same cache in the meantime
+            shutil.rmtree(tmp_dir)
+
+    def load_encoded(self, path: Union[str, pathlib.Path]):
+        """
+        Loads an encoded dataset saved with `save_encoded`. The arrays are memory-mapped, so
+        processes loading the same cache share its pages.
+        """
+        path = pathlib.Path(path)
+        self.check_cache_version(path)
+        for name in self.ENCODED_ARRAYS:
+            array_path = path / f"{name}.npy"
+            if array_path.exists():
+                setattr(self, name, np.load(array_path, mmap_mode="r"))
+            elif name.startswith("bert_"):
+                setattr(self, name, None)
+            else:
+                raise ValueError(f"{path} is not a valid dataset cache: no {name} array")
+        if len(self.sent_offsets) != len(self.treelist) + 1:
+            raise ValueError(f"{path} is not a cache for this dataset")
+
+    @classmethod
+    def check_cache_version(cls, path: Union[str, pathlib.Path]):
+        """
+        Raises a `ValueError` if `path` is not a cache written by `save_encoded` with the current
+        `CACHE_VERSION`.
+        """
+        try:
+            version = int((pathlib.Path(path) / "version").read_text())
+        except (OSError, ValueError):
+            raise ValueError(f"{path} is not a valid dataset cache: no version") from None
+        if version != cls.CACHE_VERSION:
+            raise ValueError(
+                f"{path} is a dataset cache of version {version}, not {cls.CACHE_VERSION}"
+            )
+
+    @classmethod
+    def load_cached_trees(cls, path: Union[str, pathlib.Path]) -> List[CompactDepGraph]:
+        """
+        Loads the trees of an encoded dataset saved with `save_encoded`.
+        """
+        cls.check_cache_version(path)
+        try:
+            with open(pathlib.Path(path) / "trees.pickle", "rb") as istream:
+                return pickle.load(istream)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            raise ValueError(f"{path} is not a valid dataset cache: {e}") from e
+
+    def encoded_sentence(self, idx: int) -> Union[np.ndarray, BertLexerSentence]:
+        """
+        Returns the `idx`-th sentence encoded for the lexer.
+        """
+        start, end = self.sent_offsets[idx], self.sent_offsets[idx + 1]
+        word_indices = self.word_indices[start:end]
+        if self.bert_input_ids is None:
+            return word_indices
+        assert self.bert_offsets is not None and self.bert_alignments is not None
+        bert_start, bert_end = self.bert_offsets[idx], self.bert_offsets[idx + 1]
+        alignments = [
+            None if span_start < 0 else TokenSpan(span_start, span_end)
+            for span_start, span_end in self.bert_alignments[
+                start - idx : end - idx - 1
+            ].tolist()
+        ]
+        return BertLexerSentence(
+            word_indices.tolist(),
+            {"input_ids": self.bert_input_ids[bert_start:bert_end].tolist()},
+            alignments,
+        )
 
     def make_batches(
         self,
@@ -413,6 +981,22 @@ class DependencyDataset:
         shuffle_data: bool = True,
         order_by_length: bool = False,
     ) -> Iterable[DependencyBatch]:
+        for batch_indices in self.batches_indices(
+            batch_size,
+            shuffle_batches=shuffle_batches,
+            shuffle_data=shuffle_data,
+            order_by_length=order_by_length,
+        ):
+            yield self.make_batch(batch_indices)
+
+    def batches_indices(
+        self,
+        batch_size: int,
+        shuffle_batches: bool = False,
+        shuffle_data: bool = True,
+        order_by_length: bool = False,
+    ) -> List[List[int]]:
+        """Return the indices of the sentences of the batches of `make_batches`, in order."""
         N = len(self.treelist)
         order = list(range(N))
         if shuffle_data:
@@ -427,39 +1011,109 @@ class DependencyDataset:
         if shuffle_batches:
             shuffle(batch_order)
 
-        for i in batch_order:
-            batch_indices = order[i : i + batch_size]
-            trees = tuple(self.treelist[j] for j in batch_indices)
+        return [order[i : i + batch_size] for i in batch_order]
 
-            chars = tuple(self.char_dataset.batch_chars([t.words for t in trees]))
-            encoded_words = self.lexer.pad_batch([self.encoded_words[j] for j in batch_indices])  # type: ignore
-            heads = self.pad(
-                [self.heads[j] for j in batch_indices], padding_value=self.LABEL_PADDING
-            )
-            labels = self.pad(
-                [self.labels[j] for j in batch_indices],
-                padding_value=self.LABEL_PADDING,
-            )
-            # NOTE: this is equivalent to and faster and clearer but less pure than
-            # `torch.arange(sent_lengths.max()).unsqueeze(0).lt(sent_lengths.unsqueeze(1).logical_and(torch.arange(sent_lengths.max()).gt(0))`
-            content_mask = labels.ne(self.LABEL_PADDING)
-            sent_lengths = torch.tensor([len(t) for t in trees])
-            subwords = tuple(self.ft_dataset.batch_sentences([t.words for t in trees]))
-            tags = self.pad(
-                [self.tags[j] for j in batch_indices], padding_value=self.LABEL_PADDING
-            )
+    def make_batch(self, batch_indices: Sequence[int]) -> DependencyBatch:
+        """Make a batch of the sentences at `batch_indices`, in this order."""
+        trees = tuple(self.treelist[j] for j in batch_indices)
 
-            yield DependencyBatch(
-                chars=chars,
-                encoded_words=encoded_words,
-                heads=heads,
-                labels=labels,
-                content_mask=content_mask,
-                sent_lengths=sent_lengths,
-                subwords=subwords,
-                tags=tags,
-                trees=trees,
-            )
+        chars = self.pad_token_columns(
+            self.chars,
+            self.char_offsets,
+            batch_indices,
+            padding_value=self.char_dataset.PAD_IDX,
+        )
+        encoded_words = self.lexer.pad_batch([self.encoded_sentence(j) for j in batch_indices])  # type: ignore
+        heads = self.pad_encoded(
+            self.heads, batch_indices, padding_value=self.LABEL_PADDING
+        )
+        labels = self.pad_encoded(
+            self.labels, batch_indices, padding_value=self.LABEL_PADDING
+        )
+        # NOTE: this is equivalent to and faster and clearer but less pure than
+        # `torch.arange(sent_lengths.max()).unsqueeze(0).lt(sent_lengths.unsqueeze(1).logical_and(torch.arange(sent_lengths.max()).gt(0))`
+        content_mask = labels.ne(self.LABEL_PADDING)
+        sent_lengths = torch.tensor([len(t) for t in trees])
+        subwords = self.pad_token_columns(
+            self.subwords,
+            self.subword_offsets,
+            batch_indices,
+            padding_value=self.ft_dataset.pad_idx,
+        )
+        tags = self.pad_encoded(
+            self.tags, batch_indices, padding_value=self.LABEL_PADDING
+        )
+
+        return DependencyBatch(
+            chars=chars,
+            encoded_words=encoded_words,
+            heads=heads,
+            labels=labels,
+            content_mask=content_mask,
+            sent_lengths=sent_lengths,
+            subwords=subwords,
+            tags=tags,
+            trees=trees,
+        )
+
+    def pad_encoded(
+        self,
+        flat: np.ndarray,
+        batch_indices: Sequence[int],
+        padding_value: Optional[int] = None,
+    ) -> torch.Tensor:
+        """
+        Pads the slices of a flat encoded array that correspond to a batch of sentences.
+        """
+        if padding_value is None:
+            padding_value = self.PAD_IDX
+        starts = self.sent_offsets[batch_indices]
+        ends = self.sent_offsets[np.asarray(batch_indices) + 1]
+        res = np.full(
+            (len(batch_indices), (ends - starts).max()), padding_value, dtype=np.int64
+        )
+        for row, start, end in zip(res, starts, ends):
+            row[: end - start] = flat[start:end]
+        return torch.from_numpy(res)
+
+    def pad_token_columns(
+        self,
+        flat: np.ndarray,
+        token_offsets: np.ndarray,
+        batch_indices: Sequence[int],
+        padding_value: int,
+    ) -> Tuple[torch.Tensor, ...]:
+        """
+        Pads token-level codes (chars, subwords…) for a batch of sentences and returns them by
+        word position: the i-th element has shape `(batch_size, max_codes)` where `max_codes` is
+        the maximal number of codes of the i-th words of the sentences. Padding words count as
+        having one code.
+        """
+        starts = self.sent_offsets[batch_indices]
+        sent_lengths = self.sent_offsets[np.asarray(batch_indices) + 1] - starts
+        # Global token indices and their position in the batch
+        token_idx, word_pos = ragged_arange(starts, sent_lengths)
+        sent_pos = np.repeat(np.arange(len(batch_indices)), sent_lengths)
+
+        token_starts = token_offsets[token_idx]
+        token_lengths = token_offsets[token_idx + 1] - token_starts
+        code_lengths = np.ones((len(batch_indices), sent_lengths.max()), dtype=np.int64)
+        code_lengths[sent_pos, word_pos] = token_lengths
+        widths = code_lengths.max(axis=0)
+
+        res = np.full(
+            (len(batch_indices), sent_lengths.max(), widths.max()),
+            padding_value,
+            dtype=np.int64,
+        )
+        code_idx, code_pos = ragged_arange(token_starts, token_lengths)
+        res[
+            np.repeat(sent_pos, token_lengths),
+            np.repeat(word_pos, token_lengths),
+            code_pos,
+        ] = flat[code_idx]
+        res_tensor = torch.from_numpy(res)
+        return tuple(res_tensor[:, i, :width] for i, width in enumerate(widths))
 
     def pad(
         self, batch: List[List[int]], padding_value: Optional[int] = None
@@ -473,11 +1127,11 @@ class DependencyDataset:
             batch_first=True,
         )
 
-    def init_labels(self, treelist: Iterable[DepGraph]):
+    def init_labels(self, treelist: Iterable[CompactDepGraph]):
         self.itolab = gen_labels(treelist)
         self.labtoi = {label: idx for idx, label in enumerate(self.itolab)}
 
-    def init_tags(self, treelist: Iterable[DepGraph]):
+    def init_tags(self, treelist: Iterable[CompactDepGraph]):
         self.itotag = gen_tags(treelist)
         self.tagtoi = {tag: idx for idx, tag in enumerate(self.itotag)}
 
@@ -485,7 +1139,73 @@ class DependencyDataset:
         return len(self.treelist)
 
 
-def gen_tags(treelist: Iterable[DepGraph]) -> List[str]:
+def ragged_arange(
+    starts: np.ndarray, lengths: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the concatenation of the ranges `[starts[i], starts[i]+lengths[i])` and the position
+    of each of its elements in its range.
+    """
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + positions, positions
+
+
+def file_digest(
+    path: Union[str, pathlib.Path],
+    memo_dir: Optional[Union[str, pathlib.Path]] = None,
+) -> str:
+    """
+    Returns a digest of the content of a file. If `memo_dir` is given, the digest is stored there
+    and reused without reading the file again as long as its path, size and modification time
+    are unchanged.
+    """
+    memo_path = None
+    if memo_dir is not None:
+        stat = os.stat(path)
+        memo_key = hashlib.blake2b(
+            f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+        memo_path = pathlib.Path(memo_dir) / memo_key
+        if memo_path.exists():
+            return memo_path.read_text().strip()
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as istream:
+        for chunk in iter(lambda: istream.read(2 ** 20), b""):
+            digest.update(chunk)
+    res = digest.hexdigest()
+    if memo_path is not None:
+        memo_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=memo_path.parent, prefix=f".{memo_path.name}-", delete=False
+        ) as ostream:
+            ostream.write(f"{res}\n")
+        os.replace(ostream.name, memo_path)
+    return res
+
+
+def dataset_cache_key(
+    *paths: Union[str, pathlib.Path],
+    extra: Iterable[str] = (),
+    memo_dir: Optional[Union[str, pathlib.Path]] = None,
+) -> str:
+    """
+    Returns a key that identifies the content of a set of files (e.g. a treebank and the
+    vocabularies used to encode it), some extra parameters and the `DependencyDataset` cache
+    format, to be used as an encoded dataset cache name. `memo_dir` is passed to `file_digest`.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"v{DependencyDataset.CACHE_VERSION}\0".encode("utf-8"))
+    for path in paths:
+        digest.update(file_digest(path, memo_dir).encode("utf-8"))
+        digest.update(b"\0")
+    for value in extra:
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def gen_tags(treelist: Iterable[Union[DepGraph, CompactDepGraph]]) -> List[str]:
     tagset = set([tag for tree in treelist for tag in tree.pos_tags])
     return [
         DependencyDataset.PAD_TOKEN,
@@ -495,8 +1215,6 @@ def gen_tags(treelist: Iterable[DepGraph]) -> List[str]:
     ]
 
 
-def gen_labels(treelist: Iterable[DepGraph]) -> List[str]:
-    labels = set(
-        [lbl for tree in treelist for (_gov, lbl, _dep) in tree.get_all_edges()]
-    )
+def gen_labels(treelist: Iterable[Union[DepGraph, CompactDepGraph]]) -> List[str]:
+    labels = set([lbl for tree in treelist for lbl in tree.get_all_labels()])
     return [DependencyDataset.PAD_TOKEN, *sorted(labels)]
@@ -0,0 +1,130 @@
+"""Data parallel training in several processes with `torch.distributed`.
+
+Every process trains a replica of the parser on its share of the batches and the gradients are
+summed over the processes before every optimizer step, see
+`npdependency.graph_parser.train_distributed`. The helpers here also work in a single process
+without a process group, where they have nothing to communicate.
+"""
+import contextlib
+import itertools
+import socket
+from typing import Any, Iterable, Iterator, List, Sequence, Tuple, TypeVar, Union
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+T = TypeVar("T")
+
+# The maximal number of gradient elements summed in one communication
+GRADIENT_BUCKET_SIZE = 2**24
+
+
+def local_init_method() -> str:
+    """An address for initializing a process group on this machine, on a free port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"tcp://127.0.0.1:{port}"
+
+
+@contextlib.contextmanager
+def process_group(
+    init_method: str, rank: int, world_size: int, device: torch.device
+) -> Iterator[None]:
+    """A context in which the current process belongs to the group of `world_size` processes
+    training on `device`, which is either the CPU or a CUDA device of its own. They communicate
+    with NCCL on CUDA devices if it is available and with gloo otherwise."""
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+        backend = "nccl" if dist.is_nccl_available() else "gloo"
+    else:
+        backend = "gloo"
+    dist.init_process_group(
+        backend, init_method=init_method, rank=rank, world_size=world_size
+    )
+    try:
+        yield
+    finally:
+        dist.destroy_process_group()
+
+
+def rank_and_world_size() -> Tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def shard(items: Sequence[T], rank: int, world_size: int) -> List[T]:
+    """The share of the process `rank` of `items`.
+
+    As with `torch.utils.data.DistributedSampler`, the items are completed by repeating the
+    first ones so that every process gets as many of them, which keeps the processes in step.
+    """
+    missing = -len(items) % world_size
+    padded = [*items, *itertools.islice(itertools.cycle(items), missing)]
+    return padded[rank::world_size]
+
+
+def broadcast_object(obj: T, src: int = 0) -> T:
+    """Return the `obj` of the process `src` in every process."""
+    if rank_and_world_size()[1] == 1:
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def all_gather_object(obj: Any) -> List[Any]:
+    """Return the `obj` of every process, by rank."""
+    world_size = rank_and_world_size()[1]
+    if world_size == 1:
+        return [obj]
+    objects: List[Any] = [None] * world_size
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def all_reduce_sum(
+    values: Sequence[float], device: Union[str, torch.device]
+) -> List[float]:
+    """Sum `values` over the processes. `device` is that of the process, NCCL only
+    communicates CUDA tensors."""
+    if rank_and_world_size()[1] == 1:
+        return list(values)
+    summed = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(summed)
+    return summed.tolist()
+
+
+def all_reduce_gradients(parameters: Iterable[nn.Parameter]):
+    """Sum the gradients of `parameters` over the processes, in place.
+
+    The small gradients are concatenated in buckets of up to `GRADIENT_BUCKET_SIZE` elements,
+    which saves many tiny communications without copying the whole model at once. The
+    processes must have gradients for the same parameters.
+    """
+    if rank_and_world_size()[1] == 1:
+        return
+    bucket: List[torch.Tensor] = []
+    bucket_size = 0
+    for param in parameters:
+        if param.grad is None:
+            continue
+        if bucket and bucket_size + param.grad.numel() > GRADIENT_BUCKET_SIZE:
+            _all_reduce_bucket(bucket)
+            bucket, bucket_size = [], 0
+        bucket.append(param.grad)
+        bucket_size += param.grad.numel()
+    if bucket:
+        _all_reduce_bucket(bucket)
+
+
+def _all_reduce_bucket(grads: List[torch.Tensor]):
+    if len(grads) == 1:
+        dist.all_reduce(grads[0])
+        return
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    for grad, summed in zip(grads, flat.split([grad.numel() for grad in grads])):
+        grad.copy_(summed.view_as(grad))
@@ -1,12 +1,26 @@
+import collections
+import contextlib
+import glob
+import itertools
 import math
+import multiprocessing
+import multiprocessing.pool
 import pathlib
+import pickle
+import random
 import sys
+import threading
+import time
 from typing import (
     Any,
     Callable,
+    ContextManager,
+    Deque,
     Dict,
     Iterable,
     List,
+    NamedTuple,
+    Optional,
     Sequence,
     TextIO,
     Tuple,
@@ -14,7 +28,7 @@ from typing import (
 )
 import warnings
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-import transformers
+from torch.utils.checkpoint import checkpoint
 import yaml
 import argparse
 
@@ -25,9 +39,7 @@ import numpy as np
 
 import torch
 from torch import nn
-from npdependency import deptree
-
-from npdependency.mst import chuliu_edmonds_one_root as chuliu_edmonds
+import torch.nn.functional as F
 
 from npdependency.lexers import (
     BertBaseLexer,
@@ -36,18 +48,32 @@ from npdependency.lexers import (
     CharRNN,
     DefaultLexer,
     FastTextDataSet,
+    FastTextSubwords,
     FastTextTorch,
     freeze_module,
     make_vocab,
 )
 from npdependency.deptree import (
+    CompactDepGraph,
     DependencyBatch,
     DependencyDataset,
     DepGraph,
+    dataset_cache_key,
+    file_digest,
     gen_labels,
     gen_tags,
+    parsed_output_paths,
+    read_conll_trees,
+    write_conll,
 )
+from npdependency import bundle, checkpoints, distributed
 from npdependency import conll2018_eval as evaluator
+from npdependency.pipeline import (
+    BackgroundIterator,
+    PipelineStats,
+    StageStats,
+    parse_dataset,
+)
 
 # Python 3.7 shim
 try:
@@ -56,16 +82,57 @@ except ImportError:
     from typing_extensions import Literal, TypedDict  # type: ignore
 
 
-class MLP(nn.Module):
-    def __init__(self, input_size, hidden_size, output_size, dropout=0.0):
-        super(MLP, self).__init__()
-        self.Wdown = nn.Linear(input_size, hidden_size)
-        self.Wup = nn.Linear(hidden_size, output_size)
+class MLPSpec(NamedTuple):
+    hidden_size: int
+    output_size: int
+    dropout: float = 0.0
+
+
+class FusedMLPs(nn.Module):
+    """Several one hidden layer MLPs applied to the same input.
+
+    The hidden layers of all the MLPs are computed with a single matmul by a concatenation of
+    their weights, which is split afterwards, so this does the work of one large linear layer
+    instead of several small ones. `MLPSpec` describes each MLP.
+    """
+
+    def __init__(self, input_size: int, mlps: Sequence[MLPSpec]):
+        super(FusedMLPs, self).__init__()
+        self.hidden_sizes = [mlp.hidden_size for mlp in mlps]
+        self.Wdown = nn.Linear(input_size, sum(self.hidden_sizes))
+        self.Wups = nn.ModuleList(
+            [nn.Linear(mlp.hidden_size, mlp.output_size) for mlp in mlps]
+        )
         self.g = nn.ReLU()
-        self.dropout = nn.Dropout(p=dropout)
+        self.dropouts = nn.ModuleList([nn.Dropout(p=mlp.dropout) for mlp in mlps])
 
-    def forward(self, input):
-        return self.Wup(self.dropout(self.g(self.Wdown(input))))
+    def forward(self, input: torch.Tensor) -> List[torch.Tensor]:
+        """Return the outputs of the MLPs, in order."""
+        hidden = self.g(self.Wdown(input)).split(self.hidden_sizes, dim=-1)
+        outputs: List[torch.Tensor] = []
+        # This form of loop is the one that TorchScript can unroll
+        for i, (Wup, dropout) in enumerate(zip(self.Wups, self.dropouts)):
+            outputs.append(Wup(dropout(hidden[i])))
+        return outputs
+
+    @staticmethod
+    def fuse_state_dict(
+        state_dict: Dict[str, torch.Tensor], mlp_prefixes: Sequence[str], prefix: str
+    ):
+        """Convert in place the parameters of separate MLPs to those of a `FusedMLPs`.
+
+        The separate MLPs are the ones that this replaces, whose parameters are
+        `{mlp_prefix}.Wdown.*` and `{mlp_prefix}.Wup.*` and the converted parameters are named
+        `{prefix}.*`.
+        """
+        for param in ("weight", "bias"):
+            state_dict[f"{prefix}.Wdown.{param}"] = torch.cat(
+                [state_dict.pop(f"{mlp}.Wdown.{param}") for mlp in mlp_prefixes], dim=0
+            )
+            for i, mlp in enumerate(mlp_prefixes):
+                state_dict[f"{prefix}.Wups.{i}.{param}"] = state_dict.pop(
+                    f"{mlp}.Wup.{param}"
+                )
 
 
 # Note: This is the biaffine layer used in Qi et al. (2018) and Dozat and Manning (2017).
@@ -84,10 +151,50 @@ class BiAffine(nn.Module):
         nn.init.xavier_uniform_(self.weight)
 
     def forward(self, h: torch.Tensor, d: torch.Tensor) -> torch.Tensor:
-        if self.bias:
-            h = torch.cat((h, h.new_ones((*h.shape[:-1], 1))), dim=-1)
-            d = torch.cat((d, d.new_ones((*d.shape[:-1], 1))), dim=-1)
-        return torch.einsum("bxi,oij,byj->boxy", h, self.weight, d)
+        """Return the scores of all the pairs of vectors of `h` and `d`, with shape `(batch,
+        output_dim, h_len, d_len)`.
+
+        With a bias, the score of `x` and `y` is `x'ᵀWy'`, where `v'` is `v` with an extra
+        component equal to 1. The products with these 1 are computed apart from the bilinear
+        term instead of concatenating them to the inputs and the matmuls are arranged so that
+        the weight is never copied.
+        """
+        if self.output_dim == 1:
+            return self._single_output(h, d).unsqueeze(1)
+        return self._multiple_outputs(h, d)
+
+    def _single_output(self, h: torch.Tensor, d: torch.Tensor) -> torch.Tensor:
+        """The scores of `forward` when `output_dim` is 1, without the output dimension."""
+        weight = self.weight[0]
+        if not self.bias:
+            return torch.bmm(torch.matmul(h, weight), d.transpose(1, 2))
+        n = self.input_dim
+        # hW + the products of 1 and d
+        hw = F.linear(h, weight[:n, :n].t(), weight[n, :n])
+        # The products of h and 1 + the product of 1 and 1, shape (batch, h_len, 1)
+        h_bias = F.linear(h, weight[:n, n].unsqueeze(0), weight[n, n:])
+        return torch.baddbmm(h_bias, hw, d.transpose(1, 2))
+
+    def _multiple_outputs(self, h: torch.Tensor, d: torch.Tensor) -> torch.Tensor:
+        batch_size, h_len, n = h.shape
+        d_len = d.shape[1]
+        if not self.bias:
+            # Wd for every output, as rows of shape (batch, d_len×output_dim, input_dim)
+            dw = F.linear(d, self.weight.reshape(-1, n)).view(batch_size, -1, n)
+            scores = torch.bmm(h, dw.transpose(1, 2))
+        else:
+            # Unlike its top-left block, the first `input_dim` columns of the weight can be
+            # viewed as a matrix: the last component of Wd is the product of 1 and d
+            dw = F.linear(d, self.weight[:, :, :n].reshape(-1, n)).view(
+                batch_size, -1, n + 1
+            )
+            scores = torch.baddbmm(
+                dw[..., n].unsqueeze(1), h, dw[..., :n].transpose(1, 2)
+            )
+            # The products of h and 1 + the product of 1 and 1
+            h_bias = F.linear(h, self.weight[:, :n, n], self.weight[:, n, n])
+            scores.view(batch_size, h_len, d_len, -1).add_(h_bias.unsqueeze(2))
+        return scores.view(batch_size, h_len, d_len, -1).permute(0, 3, 1, 2)
 
 
 class Tagger(nn.Module):
@@ -99,15 +206,73 @@ class Tagger(nn.Module):
         return self.W(input)
 
 
+# The dtypes of the supported mixed precision modes
+MIXED_PRECISION_DTYPES: Dict[str, torch.dtype] = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
 class LRSchedule(TypedDict):
     shape: Literal["exponential", "linear", "constant"]
     warmup_steps: int
 
 
+def linear_schedule_with_warmup(
+    warmup_steps: int, training_steps: int
+) -> Callable[[int], float]:
+    """The LR factor for a linear increase from 0 to 1 during `warmup_steps` steps, followed by a
+    linear decrease to 0 at `training_steps`.
+
+    This is the same as 🤗 `get_linear_schedule_with_warmup`."""
+
+    def lr_factor(step: int) -> float:
+        if step < warmup_steps:
+            return step / max(1, warmup_steps)
+        return max(0.0, (training_steps - step) / max(1, training_steps - warmup_steps))
+
+    return lr_factor
+
+
+def constant_schedule_with_warmup(warmup_steps: int) -> Callable[[int], float]:
+    """The LR factor for a linear increase from 0 to 1 during `warmup_steps` steps, then
+    constant, same as 🤗 `get_constant_schedule_with_warmup`."""
+
+    def lr_factor(step: int) -> float:
+        if step < warmup_steps:
+            return step / max(1, warmup_steps)
+        return 1.0
+
+    return lr_factor
+
+
+class GradientAccumulation(TypedDict, total=False):
+    """Accumulate the gradients of `batches` batches, or of as many batches as needed to reach
+    `tokens` tokens, before each optimizer step. At most one of them can be given."""
+
+    batches: int
+    tokens: int
+
+
+def optimizer_steps_per_epoch(
+    n_batches: int, n_tokens: int, accumulation: GradientAccumulation
+) -> int:
+    """The number of optimizer steps for an epoch of `n_batches` batches with `n_tokens` tokens
+    in total. This is an upper bound when the gradients are accumulated up to a number of
+    tokens, since it depends on the composition of the batches."""
+    if "tokens" in accumulation:
+        # Every step but the last one of the epoch has at least `tokens` tokens
+        return min(n_batches, n_tokens // accumulation["tokens"] + 1)
+    return math.ceil(n_batches / accumulation.get("batches", 1))
+
+
 class BiAffineParser(nn.Module):
 
     """Biaffine Dependency Parser."""
 
+    # The MLPs fused in `self.mlps`, as they were named when they were separate modules
+    MLP_NAMES = ("pos_tagger", "arc_mlp_h", "arc_mlp_d", "lab_mlp_h", "lab_mlp_d")
+
     def __init__(
         self,
         lexer: Union[DefaultLexer, BertBaseLexer],
@@ -124,11 +289,34 @@ class BiAffineParser(nn.Module):
         labels: Sequence[str],
         biased_biaffine: bool,
         device: Union[str, torch.device],
+        mixed_precision: Optional[str] = None,
+        gradient_checkpointing: bool = False,
     ):
+        """
+        If `mixed_precision` is given (see `MIXED_PRECISION_DTYPES`), the forward passes run in
+        that precision where it is safe to do so, see `autocast`. `"fp16"` is only available on
+        CUDA devices.
+
+        If `gradient_checkpointing` is true, the training forward passes don't keep the
+        activations of the BERT model (if the lexer has one that supports it) and of the LSTM
+        encoder, they are recomputed during the backward passes. This saves memory at the cost
+        of about one more forward pass of these layers.
+        """
 
         super(BiAffineParser, self).__init__()
         self.device = torch.device(device)
+        if mixed_precision is not None:
+            if mixed_precision not in MIXED_PRECISION_DTYPES:
+                raise ValueError(f"Unknown mixed precision mode {mixed_precision!r}")
+            if not hasattr(torch, "autocast"):
+                raise ValueError("Mixed precision requires torch >= 1.10")
+            if mixed_precision == "fp16" and self.device.type != "cuda":
+                raise ValueError("fp16 mixed precision is only available on CUDA devices")
+        self.mixed_precision = mixed_precision
         self.lexer = lexer.to(self.device)
+        self.gradient_checkpointing = gradient_checkpointing
+        if gradient_checkpointing and isinstance(self.lexer, BertBaseLexer):
+            self.lexer.enable_gradient_checkpointing()
         self.dep_rnn = nn.LSTM(
             self.lexer.embedding_size
             + char_rnn.embedding_size
@@ -142,28 +330,21 @@ class BiAffineParser(nn.Module):
 
         self.tagset = tagset
         self.labels = labels
-        # POS tagger & char RNN
-        self.pos_tagger = MLP(mlp_input * 2, mlp_tag_hidden, len(self.tagset)).to(
-            self.device
-        )
         self.charset = charset
         self.char_rnn = char_rnn.to(self.device)
         self.ft_lexer = ft_lexer.to(self.device)
 
-        # Arc MLPs
-        self.arc_mlp_h = MLP(mlp_input * 2, mlp_arc_hidden, mlp_input, mlp_dropout).to(
-            self.device
-        )
-        self.arc_mlp_d = MLP(mlp_input * 2, mlp_arc_hidden, mlp_input, mlp_dropout).to(
-            self.device
-        )
-        # Label MLPs
-        self.lab_mlp_h = MLP(mlp_input * 2, mlp_lab_hidden, mlp_input, mlp_dropout).to(
-            self.device
-        )
-        self.lab_mlp_d = MLP(mlp_input * 2, mlp_lab_hidden, mlp_input, mlp_dropout).to(
-            self.device
-        )
+        # POS tagger, arc and label MLPs, see `MLP_NAMES`
+        self.mlps = FusedMLPs(
+            mlp_input * 2,
+            [
+                MLPSpec(mlp_tag_hidden, len(self.tagset)),
+                MLPSpec(mlp_arc_hidden, mlp_input, mlp_dropout),
+                MLPSpec(mlp_arc_hidden, mlp_input, mlp_dropout),
+                MLPSpec(mlp_lab_hidden, mlp_input, mlp_dropout),
+                MLPSpec(mlp_lab_hidden, mlp_input, mlp_dropout),
+            ],
+        ).to(self.device)
 
         # BiAffine layers
         self.arc_biaffine = BiAffine(mlp_input, 1, bias=biased_biaffine).to(self.device)
@@ -178,6 +359,18 @@ class BiAffineParser(nn.Module):
             mlp_lab_hidden,
         )
 
+    def autocast(self) -> ContextManager:
+        """A context in which the computations run in mixed precision if it is enabled.
+
+        Only the forward pass should run in it: the scores it returns may be in low precision,
+        convert them to fp32 for the losses and the decoding.
+        """
+        if self.mixed_precision is None:
+            return contextlib.nullcontext()
+        return torch.autocast(
+            self.device.type, dtype=MIXED_PRECISION_DTYPES[self.mixed_precision]
+        )
+
     def save_params(self, path):
         torch.save(self.state_dict(), path)
 
@@ -192,8 +385,111 @@ class BiAffineParser(nn.Module):
             state_dict.setdefault(
                 "lexer.layers_gamma", torch.ones(1, dtype=torch.float)
             )
+        try:
+            self.fuse_legacy_mlps(state_dict)
+        except ValueError as e:
+            raise ValueError(f"{e}, remove {path} to quantize the model again") from e
         self.load_state_dict(state_dict)
 
+    def load_quantized_params(self, path: str, quantized_path: str):
+        """Load the weights saved at `path` and quantize them with `quantize_dynamic`.
+
+        The quantized weights are cached at `quantized_path` with the digest of the weights at
+        `path` and the torch version, and only reused if both are unchanged. If they can't be
+        saved (e.g. in a read-only model directory), the parser is quantized again next time.
+        """
+        source = {
+            "weights_digest": file_digest(path),
+            "torch_version": torch.__version__,
+        }
+        try:
+            saved = torch.load(quantized_path, map_location=self.device)
+        except FileNotFoundError:
+            saved = None
+        except (OSError, RuntimeError, EOFError, pickle.UnpicklingError) as e:
+            print(f"Ignoring the quantized weights at {quantized_path}: {e}", file=sys.stderr)
+            saved = None
+        if isinstance(saved, dict) and saved.get("source") == source:
+            self.quantize_dynamic()
+            self.load_state_dict(saved["state_dict"])
+            return
+        self.load_params(path)
+        self.quantize_dynamic()
+        # Written atomically since several processes can load the same model
+        tmp_path = os.path.join(
+            os.path.dirname(quantized_path),
+            f".{os.path.basename(quantized_path)}.{os.getpid()}.tmp",
+        )
+        try:
+            with open(tmp_path, "wb") as out_stream:
+                torch.save(
+                    {"source": source, "state_dict": self.state_dict()}, out_stream
+                )
+            os.replace(tmp_path, quantized_path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(
+                f"Couldn't save the quantized weights to {quantized_path}: {e}",
+                file=sys.stderr,
+            )
+
+    def fuse_legacy_mlps(self, state_dict: Dict[str, torch.Tensor]):
+        """Convert in place the parameters of the separate tagger, arc and label MLPs of the
+        models saved before they were fused to those of `self.mlps`."""
+        legacy_prefix = f"{self.MLP_NAMES[0]}."
+        if f"{legacy_prefix}Wdown.weight" in state_dict:
+            FusedMLPs.fuse_state_dict(state_dict, self.MLP_NAMES, "mlps")
+        elif any(name.startswith(legacy_prefix) for name in state_dict):
+            # The quantization parameters of the separate layers can't be merged
+            raise ValueError(
+                "These quantized weights were saved before the MLPs were fused"
+            )
+
+    def assign_params(self, state_dict: Dict[str, torch.Tensor]):
+        """Use the tensors of `state_dict` as the parameters and buffers of this parser, without
+        copying them if they are already on its device (unlike `load_state_dict`)."""
+        state_dict = dict(state_dict)
+        self.fuse_legacy_mlps(state_dict)
+        own_state = self.state_dict()
+        if state_dict.keys() != own_state.keys():
+            raise ValueError(
+                "Incompatible parameters:"
+                f" missing {sorted(own_state.keys() - state_dict.keys())},"
+                f" unexpected {sorted(state_dict.keys() - own_state.keys())}"
+            )
+        for name, tensor in state_dict.items():
+            if tensor.shape != own_state[name].shape:
+                raise ValueError(
+                    f"Incompatible shape for {name}: expected {own_state[name].shape},"
+                    f" got {tensor.shape}"
+                )
+            *module_path, attribute = name.split(".")
+            module = self
+            for submodule_name in module_path:
+                module = getattr(module, submodule_name)
+            tensor = tensor.to(self.device)
+            current = getattr(module, attribute)
+            if isinstance(current, nn.Parameter):
+                tensor = nn.Parameter(tensor, requires_grad=current.requires_grad)
+            setattr(module, attribute, tensor)
+
+    def quantize_dynamic(self):
+        """Quantize the weights of the LSTM and linear layers (including those of the BERT lexer)
+        to int8 in place, activations are quantized on the fly. The biaffine layers stay in fp32.
+
+        This is meant for inference on CPU, a quantized parser can't be trained. Its parameters
+        can be saved and loaded with `save_params` and `load_params`, but only in a parser that
+        has itself been quantized.
+        """
+        if self.device.type != "cpu":
+            raise ValueError(
+                f"Quantized models can only run on CPU, not on {self.device}"
+            )
+        torch.quantization.quantize_dynamic(
+            self, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
     def forward(
         self,
         xwords: Union[torch.Tensor, BertLexerBatch],
@@ -210,26 +506,28 @@ class BiAffineParser(nn.Module):
 
         # Encodes input for tagging and parsing
         xinput = torch.cat((lex_emb, char_embed, ft_embed), dim=2)
-        packed_xinput = pack_padded_sequence(
-            xinput, sent_lengths, batch_first=True, enforce_sorted=False
-        )
-        packed_dep_embeddings, _ = self.dep_rnn(packed_xinput)
-        dep_embeddings, _ = pad_packed_sequence(packed_dep_embeddings, batch_first=True)
-
-        # Tagging
-        tag_scores = self.pos_tagger(dep_embeddings)
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            dep_embeddings = checkpoint(self.encode, xinput, sent_lengths)
+        else:
+            dep_embeddings = self.encode(xinput, sent_lengths)
 
-        # Compute the score matrices for the arcs and labels.
-        arc_h = self.arc_mlp_h(dep_embeddings)
-        arc_d = self.arc_mlp_d(dep_embeddings)
-        lab_h = self.lab_mlp_h(dep_embeddings)
-        lab_d = self.lab_mlp_d(dep_embeddings)
+        # Tagging and compute the score matrices for the arcs and labels.
+        tag_scores, arc_h, arc_d, lab_h, lab_d = self.mlps(dep_embeddings)
 
         arc_scores = self.arc_biaffine(arc_h, arc_d).squeeze(1)
         lab_scores = self.lab_biaffine(lab_h, lab_d)
 
         return tag_scores, arc_scores, lab_scores
 
+    def encode(self, xinput: torch.Tensor, sent_lengths: torch.Tensor) -> torch.Tensor:
+        """Run the LSTM encoder on padded inputs and return its padded outputs."""
+        packed_xinput = pack_padded_sequence(
+            xinput, sent_lengths, batch_first=True, enforce_sorted=False
+        )
+        packed_dep_embeddings, _ = self.dep_rnn(packed_xinput)
+        dep_embeddings, _ = pad_packed_sequence(packed_dep_embeddings, batch_first=True)
+        return dep_embeddings
+
     def parser_loss(
         self,
         tagger_scores: torch.Tensor,
@@ -273,7 +571,23 @@ class BiAffineParser(nn.Module):
         # <https://arxiv.org/abs/1805.06334>
         return tagger_loss + arc_loss + lab_loss
 
-    def eval_model(self, dev_set: DependencyDataset, batch_size: int):
+    def prefetch_batches(
+        self,
+        batches: Iterable[DependencyBatch],
+        depth: int,
+        stats: Optional[StageStats] = None,
+    ) -> BackgroundIterator[DependencyBatch]:
+        """Prepare up to `depth` batches in a background thread, in pinned memory if they are
+        meant for a CUDA device so that they can be transferred asynchronously."""
+        if self.device.type == "cuda" and depth > 0:
+            return BackgroundIterator(
+                batches, depth, transform=DependencyBatch.pin_memory, stats=stats
+            )
+        return BackgroundIterator(batches, depth, stats=stats)
+
+    def eval_model(
+        self, dev_set: DependencyDataset, batch_size: int, data_prefetch: int = 2
+    ):
 
         loss_fnc = nn.CrossEntropyLoss(
             reduction="sum", ignore_index=dev_set.LABEL_PADDING
@@ -284,8 +598,14 @@ class BiAffineParser(nn.Module):
 
         self.eval()
 
-        dev_batches = dev_set.make_batches(
-            batch_size, shuffle_batches=False, shuffle_data=False, order_by_length=True
+        dev_batches = self.prefetch_batches(
+            dev_set.make_batches(
+                batch_size,
+                shuffle_batches=False,
+                shuffle_data=False,
+                order_by_length=True,
+            ),
+            data_prefetch,
         )
         tag_acc, arc_acc, lab_acc, gloss = 0, 0, 0, 0.0
         overall_size = 0
@@ -294,12 +614,19 @@ class BiAffineParser(nn.Module):
             for batch in dev_batches:
                 overall_size += int(batch.content_mask.sum().item())
 
-                batch = batch.to(self.device)
+                batch = batch.to(self.device, non_blocking=True)
 
                 # preds
-                tagger_scores, arc_scores, lab_scores = self(
-                    batch.encoded_words, batch.chars, batch.subwords, batch.sent_lengths
-                )
+                with self.autocast():
+                    tagger_scores, arc_scores, lab_scores = self(
+                        batch.encoded_words,
+                        batch.chars,
+                        batch.subwords,
+                        batch.sent_lengths,
+                    )
+                tagger_scores = tagger_scores.float()
+                arc_scores = arc_scores.float()
+                lab_scores = lab_scores.float()
 
                 gloss += self.parser_loss(
                     tagger_scores, arc_scores, lab_scores, batch, loss_fnc
@@ -349,9 +676,61 @@ class BiAffineParser(nn.Module):
         lr: float,
         lr_schedule: LRSchedule,
         modelpath="test_model.pt",
+        data_prefetch: int = 2,
+        gradient_accumulation: Optional[GradientAccumulation] = None,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        resume: bool = False,
     ):
+        """Train the parser.
+
+        The next `data_prefetch` batches are prepared in a background thread during the training
+        steps, use `0` to prepare them synchronously.
+
+        With `gradient_accumulation`, each optimizer step uses the gradients of several batches
+        of `batch_size` sentences, so that the effective batch size is not limited by the memory
+        of the device. The losses are sums over the tokens, so the accumulated gradients are those
+        of the union of these batches. The LR schedules count optimizer steps.
+
+        If `checkpoint_path` is given, a full checkpoint of the training is saved there at the
+        end of every epoch and every `checkpoint_every` optimizer steps if it is given, see
+        `npdependency.checkpoints`. With `resume`, the training continues from that checkpoint,
+        exactly as if it had not been interrupted (provided that the data and the
+        hyperparameters are the same). The checkpoint is removed at the end of the training.
+
+        In a process group of `torch.distributed` (see `train_distributed`), every process
+        trains on its share of the batches of each epoch and the gradients are summed over the
+        processes before every optimizer step. Only the first process evaluates the parser and
+        saves its weights and the checkpoints, a training must be resumed with as many processes
+        as it was started with.
+        """
+        if resume and checkpoint_path is None:
+            raise ValueError("Resuming a training requires a checkpoint path")
+        if gradient_accumulation is None:
+            gradient_accumulation = {}
+        if (
+            len(gradient_accumulation) > 1
+            or not gradient_accumulation.keys() <= {"batches", "tokens"}
+            or any(value < 1 for value in gradient_accumulation.values())
+        ):
+            raise ValueError(
+                "Gradient accumulation must be either a positive number of batches or of"
+                f" tokens, not {gradient_accumulation!r}"
+            )
+        accumulated_batches_per_step = gradient_accumulation.get("batches", 1)
+        accumulated_tokens_per_step = gradient_accumulation.get("tokens")
+        rank, world_size = distributed.rank_and_world_size()
+        steps_per_epoch = optimizer_steps_per_epoch(
+            math.ceil(math.ceil(len(train_set) / batch_size) / world_size),
+            sum(len(tree) - 1 for tree in train_set.treelist),
+            gradient_accumulation,
+        )
 
-        print(f"Start training on {self.device}")
+        if rank == 0:
+            print(
+                f"Start training on {self.device}"
+                + (f" in {world_size} processes" if world_size > 1 else "")
+            )
         loss_fnc = nn.CrossEntropyLoss(
             reduction="sum", ignore_index=train_set.LABEL_PADDING
         )
@@ -364,156 +743,595 @@ class BiAffineParser(nn.Module):
         if lr_schedule["shape"] == "exponential":
             scheduler = torch.optim.lr_scheduler.LambdaLR(
                 optimizer,
-                (lambda n: 0.95 ** (n // (math.ceil(len(train_set) / batch_size)))),
+                (lambda n: 0.95 ** (n // steps_per_epoch)),
             )
         elif lr_schedule["shape"] == "linear":
-            scheduler = transformers.get_linear_schedule_with_warmup(
+            scheduler = torch.optim.lr_scheduler.LambdaLR(
                 optimizer,
-                lr_schedule["warmup_steps"],
-                epochs * math.ceil(len(train_set) / batch_size) + 1,
+                linear_schedule_with_warmup(
+                    lr_schedule["warmup_steps"],
+                    epochs * steps_per_epoch + 1,
+                ),
             )
         elif lr_schedule["shape"] == "constant":
-            scheduler = transformers.get_linear_constant_with_warmup(
-                optimizer, lr_schedule["warmup_steps"]
+            scheduler = torch.optim.lr_scheduler.LambdaLR(
+                optimizer, constant_schedule_with_warmup(lr_schedule["warmup_steps"])
             )
         else:
             raise ValueError(f"Unkown lr schedule shape {lr_schedule['shape']!r}")
 
-        for e in range(epochs):
-            train_loss = 0.0
-            best_arc_acc = 0.0
-            overall_size = 0
-            train_batches = train_set.make_batches(
-                batch_size,
-                shuffle_batches=True,
-                shuffle_data=True,
-                order_by_length=False,
+        # fp16 gradients need scaling to avoid underflows, for other precisions this is a no-op
+        scaler = torch.cuda.amp.GradScaler(enabled=self.mixed_precision == "fp16")
+
+        def optimizer_step():
+            distributed.all_reduce_gradients(self.parameters())
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            optimizer.zero_grad()
+
+        best_arc_acc = 0.0
+        optimizer_steps = 0
+        start_epoch = 0
+        # The sentences of the batches of the current epoch, if it has started
+        epoch_batches: Optional[List[List[int]]] = None
+        batches_done, train_loss, overall_size = 0, 0.0, 0
+        if resume:
+            assert checkpoint_path is not None
+            state = checkpoints.load_checkpoint(checkpoint_path)
+            if state["world_size"] != world_size:
+                raise ValueError(
+                    f"This checkpoint was saved by a training in {state['world_size']}"
+                    f" processes, it can't be resumed in {world_size}"
+                )
+            self.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            scheduler.load_state_dict(state["scheduler"])
+            scaler.load_state_dict(state["scaler"])
+            best_arc_acc = state["best_arc_acc"]
+            optimizer_steps = state["optimizer_steps"]
+            start_epoch = state["epoch"]
+            epoch_batches = state["epoch_batches"]
+            batches_done = state["batches_done"]
+            process_state = state["processes"][rank]
+            train_loss = process_state["train_loss"]
+            overall_size = process_state["overall_size"]
+            checkpoints.set_rng_states(process_state["rng"])
+            del state, process_state
+            if rank == 0:
+                print(
+                    f"Resuming training at epoch {start_epoch}"
+                    f" after {optimizer_steps} optimizer steps"
+                )
+
+        checkpoint_writer = (
+            checkpoints.AsyncCheckpointWriter(checkpoint_path)
+            if checkpoint_path is not None and rank == 0
+            else None
+        )
+
+        def save_checkpoint(epoch: int):
+            assert checkpoint_path is not None
+            # What differs between the processes, which all have to take part
+            processes = distributed.all_gather_object(
+                {
+                    "rng": checkpoints.rng_states(),
+                    "train_loss": train_loss,
+                    "overall_size": overall_size,
+                }
+            )
+            if checkpoint_writer is None:
+                return
+            checkpoint_writer.save(
+                {
+                    "model": self.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scheduler": scheduler.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "best_arc_acc": best_arc_acc,
+                    "optimizer_steps": optimizer_steps,
+                    "epoch": epoch,
+                    "epoch_batches": epoch_batches,
+                    "batches_done": batches_done,
+                    "world_size": world_size,
+                    "processes": processes,
+                }
+            )
+
+        for e in range(start_epoch, epochs):
+            if epoch_batches is None:
+                epoch_batches = train_set.batches_indices(
+                    batch_size,
+                    shuffle_batches=True,
+                    shuffle_data=True,
+                    order_by_length=False,
+                )
+                # The processes must agree on the batches before sharing them
+                epoch_batches = distributed.broadcast_object(epoch_batches)
+                batches_done, train_loss, overall_size = 0, 0.0, 0
+            process_batches = distributed.shard(epoch_batches, rank, world_size)
+            train_batches = self.prefetch_batches(
+                (
+                    train_set.make_batch(batch_indices)
+                    for batch_indices in process_batches[batches_done:]
+                ),
+                data_prefetch,
             )
             self.train()
+            optimizer.zero_grad()
+            accumulated_batches, accumulated_tokens = 0, 0
+            epoch_start = time.perf_counter()
             for batch in train_batches:
-                overall_size += int(batch.content_mask.sum().item())
+                batch_tokens = int(batch.content_mask.sum().item())
+                overall_size += batch_tokens
 
-                batch = batch.to(self.device)
+                batch = batch.to(self.device, non_blocking=True)
 
                 # FORWARD
-                tagger_scores, arc_scores, lab_scores = self(
-                    batch.encoded_words, batch.chars, batch.subwords, batch.sent_lengths
-                )
+                with self.autocast():
+                    tagger_scores, arc_scores, lab_scores = self(
+                        batch.encoded_words,
+                        batch.chars,
+                        batch.subwords,
+                        batch.sent_lengths,
+                    )
 
+                # The loss is always computed in fp32
                 loss = self.parser_loss(
-                    tagger_scores, arc_scores, lab_scores, batch, loss_fnc
+                    tagger_scores.float(),
+                    arc_scores.float(),
+                    lab_scores.float(),
+                    batch,
+                    loss_fnc,
                 )
                 train_loss += loss.item()
 
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                scheduler.step()
-
-            dev_loss, dev_tag_acc, dev_arc_acc, dev_lab_acc = self.eval_model(
-                dev_set, batch_size
-            )
-            print(
-                f"Epoch {e} train mean loss {train_loss / overall_size}"
-                f" valid mean loss {dev_loss} valid tag acc {dev_tag_acc} valid arc acc {dev_arc_acc} valid label acc {dev_lab_acc}"
-                f" Base LR {scheduler.get_last_lr()[0]}"
+                scaler.scale(loss).backward()
+                batches_done += 1
+                accumulated_batches += 1
+                if accumulated_tokens_per_step is not None and world_size > 1:
+                    # The processes must step together, so they count all their tokens
+                    batch_tokens = int(
+                        distributed.all_reduce_sum([batch_tokens], self.device)[0]
+                    )
+                accumulated_tokens += batch_tokens
+                if (
+                    accumulated_tokens >= accumulated_tokens_per_step
+                    if accumulated_tokens_per_step is not None
+                    else accumulated_batches >= accumulated_batches_per_step
+                ):
+                    optimizer_step()
+                    optimizer_steps += 1
+                    accumulated_batches, accumulated_tokens = 0, 0
+                    if (
+                        checkpoint_every is not None
+                        and optimizer_steps % checkpoint_every == 0
+                        and batches_done < len(process_batches)
+                    ):
+                        save_checkpoint(e)
+            # The gradients are not accumulated across epochs
+            if accumulated_batches:
+                optimizer_step()
+                optimizer_steps += 1
+            train_time = time.perf_counter() - epoch_start
+            epoch_loss, epoch_size = distributed.all_reduce_sum(
+                [train_loss, overall_size], self.device
             )
 
-            if dev_arc_acc > best_arc_acc:
-                self.save_params(modelpath)
-                best_arc_acc = dev_arc_acc
+            if rank == 0:
+                dev_loss, dev_tag_acc, dev_arc_acc, dev_lab_acc = self.eval_model(
+                    dev_set, batch_size, data_prefetch=data_prefetch
+                )
+                print(
+                    f"Epoch {e} train mean loss {epoch_loss / epoch_size}"
+                    f" valid mean loss {dev_loss} valid tag acc {dev_tag_acc} valid arc acc {dev_arc_acc} valid label acc {dev_lab_acc}"
+                    f" Base LR {scheduler.get_last_lr()[0]}"
+                    f" data wait {train_batches.wait_time / train_time:.1%}"
+                )
+
+                if dev_arc_acc > best_arc_acc:
+                    self.save_params(modelpath)
+                    best_arc_acc = dev_arc_acc
+
+            epoch_batches = None
+            if checkpoint_path is not None:
+                save_checkpoint(e + 1)
 
+        if rank != 0:
+            return
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
+            assert checkpoint_path is not None
+            os.remove(checkpoint_path)
         self.load_params(modelpath)
         self.save_params(modelpath)
 
-    def predict_batch(
+    def parse(
         self,
         test_set: DependencyDataset,
-        ostream: TextIO,
         batch_size: int,
+        sink: Callable[[List[CompactDepGraph]], Any],
         greedy: bool = False,
-    ):
+        order_by_length: bool = False,
+        data_prefetch: int = 2,
+        decode_queue: int = 2,
+        stats: Optional[PipelineStats] = None,
+    ) -> PipelineStats:
+        """Parse a dataset and pass the parsed trees to `sink` in the dataset order, by runs of
+        consecutive trees as soon as they are available.
+
+        Parsing is a pipeline of three stages that run concurrently: the next `data_prefetch`
+        batches are prepared in a background thread, the model runs in the calling thread and its
+        outputs are decoded (and passed to `sink`) in another background thread, with up to
+        `decode_queue` batches waiting for it. Use `0` for either to run that stage synchronously.
+
+        If `order_by_length` is true, the batches are made of sentences of similar lengths, which
+        reduces padding, the output order is restored by the decoding stage.
+
+        The activity of the stages is added to `stats` if it is given, which is returned in any
+        case, to see which stage limits the throughput.
+        """
         self.eval()
-        # keep natural order here
-        test_batches = test_set.make_batches(
-            batch_size, shuffle_batches=False, shuffle_data=False, order_by_length=False
-        )
 
-        out_trees: List[DepGraph] = []
-
-        with torch.no_grad():
-            for batch in test_batches:
-                batch = batch.to(self.device)
-
-                # batch prediction
-                tagger_scores_batch, arc_scores_batch, lab_scores_batch = self(
+        def run_model(
+            batch: DependencyBatch,
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            batch = batch.to(self.device, non_blocking=True)
+            with self.autocast():
+                tagger_scores, arc_scores, lab_scores = self(
                     batch.encoded_words,
                     batch.chars,
                     batch.subwords,
                     batch.sent_lengths,
                 )
-                arc_scores_batch = arc_scores_batch.cpu()
+            # Everything the decoding needs, computed for the whole batch and moved to the CPU
+            # once, which also waits for the computations on the device
+            tag_ids = tagger_scores.argmax(dim=-1).cpu().numpy()
+            # The best label of every possible arc, indexed by [sentence, head, dep]
+            best_labels = lab_scores.argmax(dim=1).cpu().numpy()
+            # The MST is always computed in fp32
+            return tag_ids, arc_scores.float().cpu().numpy(), best_labels
 
-                for (tree, length, tagger_scores, arc_scores, lab_scores) in zip(
-                    batch.trees,
-                    batch.sent_lengths,
-                    tagger_scores_batch,
-                    arc_scores_batch,
-                    lab_scores_batch,
-                ):
-                    # Predict heads
-                    probs = arc_scores.numpy().T
-                    batch_width, _ = probs.shape
-                    mst_heads = (
-                        np.argmax(probs[:length, :length], axis=1)
-                        if greedy
-                        else chuliu_edmonds(probs[:length, :length])
-                    )
-                    mst_heads = torch.from_numpy(
-                        np.pad(mst_heads, (0, batch_width - length))
-                    ).to(self.device)
-
-                    # Predict tags
-                    tag_idxes = tagger_scores.argmax(dim=1)
-                    pos_tags = [test_set.itotag[idx] for idx in tag_idxes]
-                    # Predict labels
-                    select = mst_heads.unsqueeze(0).expand(lab_scores.size(0), -1)
-                    selected = torch.gather(lab_scores, 1, select.unsqueeze(1)).squeeze(
-                        1
-                    )
-                    mst_labels = selected.argmax(dim=0)
-                    edges = [
-                        deptree.Edge(head.item(), test_set.itolab[lbl], dep)
-                        for (dep, lbl, head) in zip(
-                            list(range(length)), mst_labels, mst_heads
-                        )
-                    ]
-                    out_trees.append(
-                        DepGraph(
-                            edges[1:],
-                            wordlist=tree.words[1:],
-                            pos_tags=pos_tags[1:],
-                            mwe_ranges=tree.mwe_ranges,
-                            metadata=tree.metadata,
-                        )
-                    )
+        with torch.no_grad():
+            return parse_dataset(
+                test_set,
+                batch_size,
+                run_model,
+                sink,
+                greedy=greedy,
+                order_by_length=order_by_length,
+                data_prefetch=data_prefetch,
+                decode_queue=decode_queue,
+                # Pinned batches can be moved to a CUDA device asynchronously
+                batch_transform=(
+                    DependencyBatch.pin_memory if self.device.type == "cuda" else None
+                ),
+                stats=stats,
+            )
+
+    def predict_batch(
+        self,
+        test_set: DependencyDataset,
+        ostream: TextIO,
+        batch_size: int,
+        greedy: bool = False,
+        order_by_length: bool = False,
+        stats: Optional[PipelineStats] = None,
+    ) -> PipelineStats:
+        """Parse a dataset and write the parsed trees to `ostream` in the dataset order.
+
+        See `parse` for the details of the pipeline and of `stats`.
+        """
+
+        def write(trees: List[CompactDepGraph]):
+            write_conll(trees, ostream)
+
+        return self.parse(
+            test_set,
+            batch_size,
+            write,
+            greedy=greedy,
+            order_by_length=order_by_length,
+            stats=stats,
+        )
+
+    def encode_trees(
+        self,
+        trees: List[CompactDepGraph],
+        ft_dataset: Optional[FastTextDataSet] = None,
+    ) -> DependencyDataset:
+        """Encode trees with the vocabularies of this parser, for parsing."""
+        if ft_dataset is None:
+            # FIXME: the special tokens should be saved somewhere instead of hardcoded
+            ft_dataset = FastTextDataSet(
+                self.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN]
+            )
+        return DependencyDataset(
+            trees,
+            self.lexer,
+            self.charset,
+            ft_dataset,
+            use_labels=self.labels,
+            use_tags=self.tagset,
+        )
+
+    def parse_stream(
+        self,
+        trees: Iterable[CompactDepGraph],
+        batch_size: int,
+        sink: Callable[[List[CompactDepGraph]], Any],
+        window_size: int = 4096,
+        greedy: bool = False,
+        order_by_length: bool = False,
+        stats: Optional[PipelineStats] = None,
+        workers: int = 1,
+        threads_per_worker: Optional[int] = None,
+    ) -> PipelineStats:
+        """Parse a possibly unbounded stream of trees and pass the parsed trees to `sink`.
+
+        The trees are encoded and parsed by windows of `window_size` sentences, which bounds the
+        memory used regardless of the size of the input. Within a window, batches are made of
+        sentences of similar lengths if `order_by_length` is true, which is faster, but the output
+        order is always the input order. The parses can change with the composition of the
+        batches, since the character embeddings of the words are computed on padded sequences:
+        only the default order gives the same parses as earlier versions. The activity of the
+        parsing pipeline over all the windows is added to `stats` (see `parse`).
+
+        With `workers > 1`, the windows are parsed in parallel by that many processes forked from
+        the current one, which share the weights of the parser as long as they are not modified.
+        Each of them uses `threads_per_worker` torch threads, by default the number of CPUs
+        divided by the number of workers. This is only available on platforms that can fork and
+        mostly meant for parsing on CPU.
+        """
+        if stats is None:
+            stats = PipelineStats("batching", "model", "decoding")
+        trees = iter(trees)
+        windows = iter(lambda: list(itertools.islice(trees, window_size)), [])
+        if workers <= 1:
+            ft_dataset = FastTextDataSet(
+                self.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN]
+            )
+            for window in windows:
+                self.parse(
+                    self.encode_trees(window, ft_dataset),
+                    batch_size,
+                    sink,
+                    greedy=greedy,
+                    order_by_length=order_by_length,
+                    stats=stats,
+                )
+            return stats
+
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        global _worker_setup
+        _worker_setup = _WorkerSetup(self, batch_size, greedy, order_by_length)
+        try:
+            with multiprocessing.get_context("fork").Pool(
+                workers,
+                initializer=torch.set_num_threads,
+                initargs=(threads_per_worker,),
+            ) as pool:
+                # Keep every worker busy but don't read more of the input than necessary: a
+                # `Pool.imap` would consume the whole stream right away
+                in_progress: Deque[multiprocessing.pool.AsyncResult] = collections.deque()
+                for window in windows:
+                    in_progress.append(pool.apply_async(_parse_in_worker, (window,)))
+                    if len(in_progress) < 2 * workers:
+                        continue
+                    parsed, window_stats = in_progress.popleft().get()
+                    stats.update(window_stats)
+                    sink(parsed)
+                while in_progress:
+                    parsed, window_stats = in_progress.popleft().get()
+                    stats.update(window_stats)
+                    sink(parsed)
+        finally:
+            _worker_setup = None
+        return stats
+
+    def predict_stream(
+        self,
+        trees: Iterable[CompactDepGraph],
+        ostream: TextIO,
+        batch_size: int,
+        window_size: int = 4096,
+        greedy: bool = False,
+        order_by_length: bool = False,
+        stats: Optional[PipelineStats] = None,
+        workers: int = 1,
+        threads_per_worker: Optional[int] = None,
+    ) -> PipelineStats:
+        """Parse a possibly unbounded stream of trees and write them to `ostream` as soon as they
+        are parsed.
+
+        See `parse_stream` for the other parameters.
+        """
+
+        def write(trees: List[CompactDepGraph]):
+            write_conll(trees, ostream)
+            ostream.flush()
+
+        return self.parse_stream(
+            trees,
+            batch_size,
+            write,
+            window_size=window_size,
+            greedy=greedy,
+            order_by_length=order_by_length,
+            stats=stats,
+            workers=workers,
+            threads_per_worker=threads_per_worker,
+        )
+
+    def predict_files(
+        self,
+        paths: Iterable[Tuple[Union[str, pathlib.Path], Union[str, pathlib.Path]]],
+        batch_size: int,
+        window_size: int = 4096,
+        greedy: bool = False,
+        order_by_length: bool = False,
+        stats: Optional[PipelineStats] = None,
+        workers: int = 1,
+        threads_per_worker: Optional[int] = None,
+    ) -> PipelineStats:
+        """Parse several files, given as `(input_path, output_path)` pairs.
+
+        All the files are parsed as a single stream (see `parse_stream` for the parameters), so
+        batches can span file boundaries, and each output file is closed as soon as it is
+        complete, with a summary of its parsing speed on stderr.
+        """
+        # Guards the bookkeeping, which is shared by the reading and the decoding threads
+        lock = threading.Lock()
+        # The output files that are not complete yet, in input order
+        pending: Deque[_ParsedFile] = collections.deque()
+
+        def close_complete():
+            while pending and pending[0].complete:
+                output = pending.popleft()
+                output.ostream.close()
+                duration = time.perf_counter() - output.start
+                print(
+                    f"Parsed {output.n_trees} sentences from {output.input_path}"
+                    f" in {duration:.2f}s ({output.n_trees / duration:.1f} sentences/s)",
+                    file=sys.stderr,
+                )
 
-        for tree in out_trees:
-            print(str(tree), file=ostream, end="\n\n")
+        def read_trees() -> Iterable[CompactDepGraph]:
+            for input_path, output_path in paths:
+                output = _ParsedFile(input_path, open(output_path, "w"))
+                with lock:
+                    pending.append(output)
+                n_trees = 0
+                with open(input_path) as istream:
+                    for tree in read_conll_trees(istream):
+                        n_trees += 1
+                        yield tree
+                # The next trees belong to the next file, if any
+                with lock:
+                    output.n_trees = n_trees
+                    close_complete()
+
+        def write(trees: List[CompactDepGraph]):
+            with lock:
+                while trees:
+                    # Parsed trees belong to the first incomplete file, as long as it is
+                    # incomplete: if its size isn't known yet, it is still being read and it
+                    # is the only file that has been parsed from
+                    output = pending[0]
+                    n_trees = (
+                        len(trees)
+                        if output.n_trees is None
+                        else output.n_trees - output.written
+                    )
+                    write_conll(trees[:n_trees], output.ostream)
+                    output.written += len(trees[:n_trees])
+                    trees = trees[n_trees:]
+                    close_complete()
+
+        try:
+            stats = self.parse_stream(
+                read_trees(),
+                batch_size,
+                write,
+                window_size=window_size,
+                greedy=greedy,
+                order_by_length=order_by_length,
+                stats=stats,
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+            )
+        finally:
+            for output in pending:
+                output.ostream.close()
+        return stats
 
     @classmethod
     def from_config(
         cls, config_path: Union[str, pathlib.Path], overrides: Dict[str, Any]
     ) -> "BiAffineParser":
+        """Load a parser from its configuration file or from a bundle (see `save_bundle`), the
+        hyperparameters in `overrides` supersede the saved ones."""
         config_path = pathlib.Path(config_path)
+        if bundle.is_bundle(config_path):
+            return cls.from_bundle(config_path, overrides)
         with open(config_path) as in_stream:
             hp = yaml.load(in_stream, Loader=yaml.SafeLoader)
         hp.update(overrides)
         hp.setdefault("device", "cpu")
 
         config_dir = config_path.parent
-        ordered_vocab = loadlist(config_dir / "vocab.lst")
+        parser = cls.from_hyperparameters(
+            hp,
+            ordered_vocab=loadlist(config_dir / "vocab.lst"),
+            charset=loadlist(config_dir / "charcodes.lst"),
+            ft_lexer=FastTextTorch.loadmodel(str(config_dir / "fasttext_model.bin")),
+            itolab=loadlist(config_dir / "labcodes.lst"),
+            itotag=loadlist(config_dir / "tagcodes.lst"),
+        )
+        weights_file = config_dir / "model.pt"
+        quantization = hp.get("quantize")
+        if quantization is None:
+            if weights_file.exists():
+                parser.load_params(str(weights_file))
+            else:
+                parser.save_params(str(weights_file))
+        elif quantization == "dynamic":
+            parser.load_quantized_params(
+                str(weights_file), str(config_dir / "model.int8.pt")
+            )
+        else:
+            raise ValueError(f"Unknown quantization {quantization!r}")
+
+        parser.freeze_from_hyperparameters(hp)
+        return parser
 
+    @classmethod
+    def from_bundle(
+        cls, bundle_path: Union[str, pathlib.Path], overrides: Dict[str, Any]
+    ) -> "BiAffineParser":
+        """Load a parser saved with `save_bundle`.
+
+        On CPU, the weights of the parser are memory-mapped from the bundle, see
+        `npdependency.bundle`.
+        """
+        metadata, state_dict = bundle.load_bundle(bundle_path)
+        hp = {**metadata["hyperparameters"], **overrides}
+        hp.setdefault("device", "cpu")
+        # The FastText embeddings are in the weights
+        ft_lexer = FastTextTorch(
+            FastTextSubwords(**metadata["fasttext"]),
+            embedding_size=state_dict["ft_lexer.embeddings.weight"].shape[1],
+        )
+        parser = cls.from_hyperparameters(
+            hp,
+            ordered_vocab=metadata["vocab"],
+            charset=metadata["charset"],
+            ft_lexer=ft_lexer,
+            itolab=metadata["labels"],
+            itotag=metadata["tags"],
+        )
+        parser.assign_params(state_dict)
+        quantization = hp.get("quantize")
+        if quantization == "dynamic":
+            parser.quantize_dynamic()
+        elif quantization is not None:
+            raise ValueError(f"Unknown quantization {quantization!r}")
+        parser.freeze_from_hyperparameters(hp)
+        return parser
+
+    @classmethod
+    def from_hyperparameters(
+        cls,
+        hp: Dict[str, Any],
+        ordered_vocab: Sequence[str],
+        charset: Sequence[str],
+        ft_lexer: FastTextTorch,
+        itolab: Sequence[str],
+        itotag: Sequence[str],
+    ) -> "BiAffineParser":
+        """Build a new parser, the weights are initialized at random (except those of the
+        FastText and BERT models)."""
         lexer: Union[DefaultLexer, BertBaseLexer]
         if hp["lexer"] == "default":
             lexer = DefaultLexer(
@@ -540,20 +1358,12 @@ class BiAffineParser(nn.Module):
             )
 
         # char rnn processor
-        ordered_charset = CharDataSet(
-            loadlist(config_dir / "charcodes.lst"),
-            special_tokens=[DepGraph.ROOT_TOKEN],
-        )
+        ordered_charset = CharDataSet(charset, special_tokens=[DepGraph.ROOT_TOKEN])
         char_rnn = CharRNN(
             len(ordered_charset), hp["char_embedding_size"], hp["charlstm_output_size"]
         )
 
-        # fasttext lexer
-        ft_lexer = FastTextTorch.loadmodel(str(config_dir / "fasttext_model.bin"))
-
-        itolab = loadlist(config_dir / "labcodes.lst")
-        itotag = loadlist(config_dir / "tagcodes.lst")
-        parser = cls(
+        return cls(
             lexer=lexer,
             charset=ordered_charset,
             char_rnn=char_rnn,
@@ -568,23 +1378,45 @@ class BiAffineParser(nn.Module):
             mlp_dropout=hp["mlp_dropout"],
             biased_biaffine=hp.get("biased_biaffine", True),
             device=hp["device"],
+            mixed_precision=hp.get("mixed_precision"),
+            gradient_checkpointing=hp.get("gradient_checkpointing", False),
         )
-        weights_file = config_dir / "model.pt"
-        if weights_file.exists():
-            parser.load_params(str(weights_file))
-        else:
-            parser.save_params(str(weights_file))
 
+    def freeze_from_hyperparameters(self, hp: Dict[str, Any]):
         if hp.get("freeze_fasttext", False):
-            freeze_module(ft_lexer)
+            freeze_module(self.ft_lexer)
         if hp.get("freeze_bert", False):
             try:
-                freeze_module(lexer.bert)
+                freeze_module(self.lexer.bert)
             except AttributeError:
                 print(
                     "Warning: a non-BERT lexer has no BERT to freeze, ignoring `freeze_bert` hypereparameter"
                 )
-        return parser
+
+    def save_bundle(self, path: Union[str, pathlib.Path], hp: Dict[str, Any]):
+        """Save this parser and its hyperparameters `hp` as a single file, to be loaded with
+        `from_config` or `from_bundle`."""
+        state_dict = self.state_dict()
+        if not all(isinstance(value, torch.Tensor) for value in state_dict.values()):
+            raise ValueError(
+                "Quantized parsers can't be bundled, bundle the full precision parser and"
+                " quantize it when loading it instead"
+            )
+        # These are options for loading the parser, not properties of the model
+        hyperparameters = {
+            key: value
+            for key, value in hp.items()
+            if key not in ("device", "quantize", "mixed_precision")
+        }
+        metadata = {
+            "hyperparameters": hyperparameters,
+            "vocab": list(self.lexer.itos),
+            "charset": self.charset.i2c[2:],
+            "labels": list(self.labels),
+            "tags": list(self.tagset),
+            "fasttext": self.ft_lexer.subwords().to_dict(),
+        }
+        bundle.save_bundle(path, metadata, state_dict)
 
 
 class GridSearch:
@@ -629,6 +1461,108 @@ class GridSearch:
         )
 
 
+def train_distributed(
+    make_parser: Callable[[int], BiAffineParser],
+    nprocs: int,
+    train_args: Dict[str, Any],
+    threads_per_process: Optional[int] = None,
+):
+    """Train a parser with `BiAffineParser.train_model(**train_args)` in `nprocs` processes
+    forked from the current one, see `npdependency.distributed`.
+
+    The process `rank` trains `make_parser(rank)`, which must be on CPU or on a CUDA device of
+    its own. On CPU, it can be the same parser for every process: they share its weights as long
+    as they are not modified, and each of them uses `threads_per_process` torch threads, by
+    default the number of CPUs divided by `nprocs`. CUDA can't be used in forked processes once
+    it has been initialized, so the parsers must be loaded on their GPUs by `make_parser`.
+
+    An optimizer step uses the gradients of `nprocs` batches (times the gradient
+    accumulation). The best weights are saved in `train_args["modelpath"]`, the parsers of the
+    current process are not modified.
+    """
+    torch.multiprocessing.start_processes(
+        _train_in_process,
+        args=(
+            make_parser,
+            nprocs,
+            distributed.local_init_method(),
+            threads_per_process,
+            random.getstate(),
+            train_args,
+        ),
+        nprocs=nprocs,
+        start_method="fork",
+    )
+
+
+def _train_in_process(
+    rank: int,
+    make_parser: Callable[[int], BiAffineParser],
+    nprocs: int,
+    init_method: str,
+    threads_per_process: Optional[int],
+    random_state: Any,
+    train_args: Dict[str, Any],
+):
+    # `random` is reseeded in forked processes, seeded trainings should be reproducible
+    random.setstate(random_state)
+    parser = make_parser(rank)
+    if parser.device.type == "cpu":
+        if threads_per_process is None:
+            threads_per_process = max(1, (os.cpu_count() or 1) // nprocs)
+        torch.set_num_threads(threads_per_process)
+    with distributed.process_group(init_method, rank, nprocs, parser.device):
+        # The processes inherited the same torch random state, use different dropout masks
+        torch.manual_seed(torch.initial_seed() + rank)
+        parser.train_model(**train_args)
+
+
+class _WorkerSetup(NamedTuple):
+    parser: BiAffineParser
+    batch_size: int
+    greedy: bool
+    order_by_length: bool
+
+
+# Set by `BiAffineParser.parse_stream` before forking its worker processes, which inherit it
+_worker_setup: Optional[_WorkerSetup] = None
+
+
+def _parse_in_worker(
+    window: List[CompactDepGraph],
+) -> Tuple[List[CompactDepGraph], PipelineStats]:
+    assert _worker_setup is not None
+    parser = _worker_setup.parser
+    parsed: List[CompactDepGraph] = []
+    # The workers already run in parallel, no need for more threads
+    stats = parser.parse(
+        parser.encode_trees(window),
+        _worker_setup.batch_size,
+        parsed.extend,
+        greedy=_worker_setup.greedy,
+        order_by_length=_worker_setup.order_by_length,
+        data_prefetch=0,
+        decode_queue=0,
+    )
+    return parsed, stats
+
+
+class _ParsedFile:
+    """The progress of the parsing of a file in `BiAffineParser.predict_files`."""
+
+    def __init__(self, input_path: Union[str, pathlib.Path], ostream: TextIO):
+        self.input_path = input_path
+        self.ostream = ostream
+        self.start = time.perf_counter()
+        # Only known once the input file has been read entirely
+        self.n_trees: Optional[int] = None
+        self.written = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.n_trees is not None and self.written == self.n_trees
+
+
 def savelist(strlist, filename):
     with open(filename, "w") as ostream:
         ostream.write("\n".join(strlist))
@@ -640,50 +1574,103 @@ def loadlist(filename):
     return strlist
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Graph based Attention based dependency parser/tagger"
-    )
-    parser.add_argument(
-        "config_file", metavar="CONFIG_FILE", type=str, help="the configuration file"
-    )
-    parser.add_argument(
-        "--train_file", metavar="TRAIN_FILE", type=str, help="the conll training file"
-    )
-    parser.add_argument(
-        "--dev_file", metavar="DEV_FILE", type=str, help="the conll development file"
-    )
-    parser.add_argument(
-        "--pred_file", metavar="PRED_FILE", type=str, help="the conll file to parse"
+def load_hyperparameters(config_path: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    """Return the hyperparameters of a model from its configuration file or its bundle."""
+    if bundle.is_bundle(config_path):
+        return bundle.read_metadata(config_path)["hyperparameters"]
+    with open(config_path) as in_stream:
+        return yaml.load(in_stream, Loader=yaml.SafeLoader)
+
+
+def dataset_cache_path(
+    cache_dir: str,
+    treebank: str,
+    model_dir: str,
+    hp: Dict[str, Any],
+    max_tree_length: Optional[int] = None,
+) -> str:
+    """The path of the encoded dataset cache for a treebank and a model. The digests of the files
+    are memoized in `cache_dir` too, so an unchanged treebank or FastText model is not read
+    again."""
+    model_files = [
+        os.path.join(model_dir, filename)
+        for filename in (
+            "vocab.lst",
+            "charcodes.lst",
+            "labcodes.lst",
+            "tagcodes.lst",
+            "fasttext_model.bin",
+        )
+    ]
+    key = dataset_cache_key(
+        treebank,
+        *model_files,
+        extra=[str(hp["lexer"]), str(max_tree_length)],
+        memo_dir=os.path.join(cache_dir, "digests"),
     )
-    parser.add_argument(
-        "--out_dir",
-        metavar="OUT_DIR",
-        type=str,
-        help="the path of the output directory (defaults to the config dir)",
+    return os.path.join(cache_dir, key)
+
+
+def expand_pred_files(patterns: Iterable[str]) -> List[str]:
+    """Expand directories into the files they contain (except already parsed files) and glob
+    patterns into the matching files."""
+    res = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            res.extend(
+                path
+                for path in sorted(glob.glob(os.path.join(pattern, "*")))
+                if os.path.isfile(path) and not path.endswith(".parsed")
+            )
+        elif os.path.exists(pattern) or not glob.has_magic(pattern):
+            res.append(pattern)
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError(f"No file matches {pattern}")
+            res.extend(matches)
+    return res
+
+
+def bundle_main(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog="graph_parser bundle",
+        description="Save a trained model as a single file that loads faster",
     )
     parser.add_argument(
-        "--fasttext",
-        metavar="PATH",
-        help="The path to either an existing FastText model or a raw text file to train one. If this option is absent, a model will be trained from the parsing train set.",
+        "config_file", metavar="CONFIG_FILE", help="the configuration file of the model"
     )
     parser.add_argument(
-        "--device",
-        metavar="DEVICE",
-        type=str,
-        help="the (torch) device to use for the parser. Supersedes configuration if given",
+        "out_file", metavar="OUT_FILE", help="the path of the bundle to write"
     )
     parser.add_argument(
-        "--overwrite",
+        "--benchmark",
         action="store_true",
-        help="If a model already exists, restart training from scratch instead of continuing.",
+        help="compare the loading times of the model and of the bundle",
     )
+    args = parser.parse_args(argv)
+
+    biaffine_parser = BiAffineParser.from_config(args.config_file, {"device": "cpu"})
+    biaffine_parser.save_bundle(args.out_file, load_hyperparameters(args.config_file))
+    del biaffine_parser
+    print(f"Saved the model bundle to {args.out_file}", file=sys.stderr)
+
+    if args.benchmark:
+        for name, path in (("directory", args.config_file), ("bundle", args.out_file)):
+            start = time.perf_counter()
+            BiAffineParser.from_config(path, {"device": "cpu"})
+            print(
+                f"Loaded the {name} in {time.perf_counter()-start:.2f}s", file=sys.stderr
+            )
+
 
-    args = parser.parse_args()
+def run(args: argparse.Namespace):
+    """Train and/or parse as asked on the command line, see `npdependency.cli`."""
+    overrides: Dict[str, Any] = dict()
     if args.device is not None:
-        overrides = {"device": args.device}
-    else:
-        overrides = dict()
+        overrides["device"] = args.device
+    if args.mixed_precision is not None:
+        overrides["mixed_precision"] = args.mixed_precision
 
     # TODO: warn about unused parameters in config
     config_file = os.path.abspath(args.config_file)
@@ -694,8 +1681,7 @@ def main():
     else:
         model_dir = os.path.dirname(config_file)
 
-    with open(config_file) as in_stream:
-        hp = yaml.load(in_stream, Loader=yaml.SafeLoader)
+    hp = load_hyperparameters(config_file)
     if "device" in hp:
         warnings.warn(
             "Setting a device directly in a configuration file is deprecated and will be removed in a future version. Use --device instead."
@@ -704,23 +1690,34 @@ def main():
     if args.train_file and args.dev_file:
         # TRAIN MODE
         weights_file = os.path.join(model_dir, "model.pt")
+        checkpoint_file = os.path.join(model_dir, "checkpoint.pt")
+        if args.resume and not os.path.exists(checkpoint_file):
+            raise ValueError(f"No training checkpoint to resume from in {model_dir}")
         if os.path.exists(weights_file):
             print(f"Found existing trained model in {model_dir}", file=sys.stderr)
             overwrite = args.overwrite
-            if args.overwrite:
+            if args.resume:
+                print(f"Resuming training from {checkpoint_file}", file=sys.stderr)
+                overwrite = False
+            elif args.overwrite:
                 print("Erasing it since --overwrite was asked", file=sys.stderr)
                 # Ensure the parser won't load existing weights
                 os.remove(weights_file)
+                if os.path.exists(checkpoint_file):
+                    os.remove(checkpoint_file)
                 overwrite = True
             else:
                 print("Continuing training", file=sys.stderr)
                 overwrite = False
         else:
             overwrite = True
-        traintrees = DependencyDataset.read_conll(args.train_file, max_tree_length=150)
-        devtrees = DependencyDataset.read_conll(args.dev_file)
-
+        max_tree_length = 150
+        traintrees: Optional[List[CompactDepGraph]] = None
         if overwrite:
+            # The vocabularies are made from the training trees, so they are always read here
+            traintrees = DependencyDataset.read_conll(
+                args.train_file, max_tree_length=max_tree_length
+            )
             fasttext_model_path = os.path.join(model_dir, "fasttext_model.bin")
             if args.fasttext is None:
                 if os.path.exists(fasttext_model_path) and not args.out_dir:
@@ -776,7 +1773,30 @@ def main():
             itotag = gen_tags(traintrees)
             savelist(itotag, os.path.join(model_dir, "tagcodes.lst"))
 
-        parser = BiAffineParser.from_config(config_file, overrides)
+        device = torch.device(overrides.get("device", hp.get("device", "cpu")))
+        distributed_on_cuda = args.nprocs > 1 and device.type == "cuda"
+        if distributed_on_cuda:
+            # The training processes can't use CUDA if it is initialized here, they load
+            # their own parsers on their GPUs and this one only encodes the data
+            parser = BiAffineParser.from_config(
+                config_file, {**overrides, "device": "cpu", "mixed_precision": None}
+            )
+        else:
+            parser = BiAffineParser.from_config(config_file, overrides)
+
+        if args.cache_dir is not None:
+            train_cache = dataset_cache_path(
+                args.cache_dir, args.train_file, model_dir, hp, max_tree_length
+            )
+            dev_cache = dataset_cache_path(args.cache_dir, args.dev_file, model_dir, hp)
+        else:
+            train_cache, dev_cache = None, None
+        # Loaded from the caches if they exist, which saves parsing the treebanks
+        if traintrees is None:
+            traintrees = DependencyDataset.read_conll(
+                args.train_file, max_tree_length=max_tree_length, cache_path=train_cache
+            )
+        devtrees = DependencyDataset.read_conll(args.dev_file, cache_path=dev_cache)
 
         ft_dataset = FastTextDataSet(
             parser.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN]
@@ -788,6 +1808,7 @@ def main():
             ft_dataset,
             use_labels=parser.labels,
             use_tags=parser.tagset,
+            cache_path=train_cache,
         )
         devset = DependencyDataset(
             devtrees,
@@ -796,9 +1817,10 @@ def main():
             ft_dataset,
             use_labels=parser.labels,
             use_tags=parser.tagset,
+            cache_path=dev_cache,
         )
 
-        parser.train_model(
+        train_args = dict(
             train_set=trainset,
             dev_set=devset,
             epochs=hp["epochs"],
@@ -808,10 +1830,32 @@ def main():
                 "lr_schedule", {"shape": "exponential", "warmup_steps": 0}
             ),
             modelpath=weights_file,
+            data_prefetch=hp.get("data_prefetch", 2),
+            gradient_accumulation=hp.get("gradient_accumulation"),
+            checkpoint_path=(
+                checkpoint_file if args.checkpoint_every or args.resume else None
+            ),
+            checkpoint_every=args.checkpoint_every,
+            resume=args.resume,
         )
+        if args.nprocs > 1:
+
+            def make_parser(rank: int) -> BiAffineParser:
+                if distributed_on_cuda:
+                    return BiAffineParser.from_config(
+                        config_file, {**overrides, "device": f"cuda:{rank}"}
+                    )
+                return parser
+
+            train_distributed(make_parser, args.nprocs, train_args)
+        else:
+            parser.train_model(**train_args)
         print("training done.", file=sys.stderr)
         # Load final params
-        parser.load_params(weights_file)
+        if distributed_on_cuda:
+            parser = BiAffineParser.from_config(config_file, overrides)
+        else:
+            parser.load_params(weights_file)
         parser.eval()
         if args.out_dir is not None:
             parsed_devset_path = os.path.join(
@@ -832,36 +1876,54 @@ def main():
             file=sys.stderr,
         )
 
-    if args.pred_file:
+    if args.pred_file or args.pred_list:
         # TEST MODE
+        if args.pred_file != ["-"]:
+            pred_files = expand_pred_files(args.pred_file if args.pred_file else [])
+            if args.pred_list is not None:
+                if args.pred_list == "-":
+                    pred_files.extend(line.strip() for line in sys.stdin if line.strip())
+                else:
+                    with open(args.pred_list) as in_stream:
+                        pred_files.extend(
+                            line.strip() for line in in_stream if line.strip()
+                        )
+            # Checked before loading the model, so that a clash fails fast
+            paths = parsed_output_paths(pred_files, args.out_dir)
+        if args.quantize is not None:
+            overrides["quantize"] = args.quantize
         parser = BiAffineParser.from_config(config_file, overrides)
         parser.eval()
-        testtrees = DependencyDataset.read_conll(args.pred_file)
-        # FIXME: the special tokens should be saved somewhere instead of hardcoded
-        ft_dataset = FastTextDataSet(
-            parser.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN]
-        )
-        testset = DependencyDataset(
-            testtrees,
-            parser.lexer,
-            parser.charset,
-            ft_dataset,
-            use_labels=parser.labels,
-            use_tags=parser.tagset,
-        )
-        if args.out_dir is not None:
-            parsed_testset_path = os.path.join(
-                args.out_dir, f"{os.path.basename(args.pred_file)}.parsed"
+        if args.pred_file == ["-"]:
+            stats = parser.predict_stream(
+                read_conll_trees(sys.stdin),
+                sys.stdout,
+                hp["batch_size"],
+                window_size=args.window_size,
+                greedy=False,
+                order_by_length=args.order_by_length,
+                workers=args.workers,
+                threads_per_worker=args.threads_per_worker,
             )
         else:
-            parsed_testset_path = os.path.join(
-                os.path.dirname(args.pred_file),
-                f"{os.path.basename(args.pred_file)}.parsed",
+            if args.out_dir is not None:
+                os.makedirs(args.out_dir, exist_ok=True)
+            print(f"Parsing {len(paths)} files", file=sys.stderr)
+            stats = parser.predict_files(
+                paths,
+                hp["batch_size"],
+                window_size=args.window_size,
+                greedy=False,
+                order_by_length=args.order_by_length,
+                workers=args.workers,
+                threads_per_worker=args.threads_per_worker,
             )
-        with open(parsed_testset_path, "w") as ostream:
-            parser.predict_batch(testset, ostream, hp["batch_size"], greedy=False)
         print("parsing done.", file=sys.stderr)
+        print(f"Parsing pipeline activity:\n{stats}", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    main()
+    # Imported here since the cli module imports this one
+    from npdependency import cli
+
+    cli.main()
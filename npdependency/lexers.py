@@ -1,4 +1,7 @@
 from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
     Iterable,
     List,
     NamedTuple,
@@ -9,13 +12,10 @@ from typing import (
 )
 import torch
 import torch.jit
-import transformers
-import fasttext
 import os.path
+import warnings
 from torch import nn
 from torch.nn.utils.rnn import pad_sequence
-from transformers import AutoModel, AutoTokenizer
-from transformers.tokenization_utils_base import BatchEncoding, TokenSpan
 from collections import Counter
 from tempfile import gettempdir
 
@@ -25,6 +25,19 @@ try:
 except ImportError:
     from typing_extensions import Final, Literal  # type: ignore
 
+# transformers and fasttext are slow to import and only needed by some models, so they are
+# imported where they are used
+if TYPE_CHECKING:
+    import fasttext
+    from transformers.tokenization_utils_base import BatchEncoding
+
+
+class TokenSpan(NamedTuple):
+    """The subwords `[start, end)` of a word, same as 🤗 `TokenSpan`."""
+
+    start: int
+    end: int
+
 
 @torch.jit.script
 def integer_dropout(t: torch.Tensor, fill_value: int, p: float) -> torch.Tensor:
@@ -165,7 +178,7 @@ class FastTextDataSet:
 
     def __init__(
         self,
-        fasttextmodel: "FastTextTorch",
+        fasttextmodel: Union["FastTextTorch", "FastTextSubwords"],
         special_tokens: Optional[Iterable[str]] = None,
     ):
         self.fasttextmodel = fasttextmodel
@@ -211,28 +224,124 @@ class FastTextDataSet:
             yield self.batch_tokens([sentence[idx] for sentence in batched_sents])
 
 
+class FastTextSubwords:
+    """
+    The subwords indexing of a FastText model, reimplemented in pure Python so that we don't
+    need to load the native model when we only need the indices (e.g. when the embeddings are
+    stored elsewhere). It gives the same indices as `FastTextTorch.subwords_idxes`.
+    """
+
+    BOW: Final[str] = "<"
+    EOW: Final[str] = ">"
+    EOS: Final[str] = "</s>"
+
+    def __init__(self, words: Sequence[str], minn: int, maxn: int, bucket: int):
+        self.words = list(words)
+        self.word_ids: Dict[str, int] = {
+            word: idx for idx, word in enumerate(self.words)
+        }
+        self.minn = minn
+        self.maxn = maxn
+        self.bucket = bucket
+        # The embeddings of the words are followed by those of the ngram buckets
+        self.vocab_size = len(self.words) + self.bucket
+
+    @staticmethod
+    def hash(ngram: bytes) -> int:
+        """The 32 bits FNV-1a hash used by FastText, including its sign extension of bytes."""
+        h = 2166136261
+        for byte in ngram:
+            if byte >= 0x80:
+                byte |= 0xFFFFFF00
+            h = ((h ^ byte) * 16777619) & 0xFFFFFFFF
+        return h
+
+    def ngram_idxes(self, token: str) -> List[int]:
+        # FastText works on utf-8 bytes but never splits a character
+        word = f"{self.BOW}{token}{self.EOW}".encode("utf-8")
+        char_starts = [i for i, byte in enumerate(word) if byte & 0xC0 != 0x80]
+        char_starts.append(len(word))
+        res = []
+        for start_idx, start in enumerate(char_starts[:-1]):
+            for n in range(1, self.maxn + 1):
+                if start_idx + n >= len(char_starts):
+                    break
+                end = char_starts[start_idx + n]
+                # Single characters are only used inside the word, not for the delimiters
+                if n >= self.minn and not (n == 1 and (start == 0 or end == len(word))):
+                    res.append(
+                        len(self.words) + self.hash(word[start:end]) % self.bucket
+                    )
+        return res
+
+    def subwords_idxes(self, token: str) -> torch.Tensor:
+        """
+        Returns a list of ft subwords indexes for the token
+        """
+        res = []
+        word_id = self.word_ids.get(token)
+        if word_id is not None:
+            res.append(word_id)
+        if token != self.EOS:
+            res.extend(self.ngram_idxes(token))
+        return torch.tensor(res, dtype=torch.long)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The parameters of this indexing, as accepted by the constructor."""
+        return {
+            "words": self.words,
+            "minn": self.minn,
+            "maxn": self.maxn,
+            "bucket": self.bucket,
+        }
+
+    @classmethod
+    def from_fasttext(
+        cls, fasttextmodel: "fasttext.FastText._FastText"
+    ) -> "FastTextSubwords":
+        args = fasttextmodel.f.getArgs()
+        return cls(fasttextmodel.words, args.minn, args.maxn, args.bucket)
+
+
 class FastTextTorch(nn.Module):
     """
     This is subword model using FastText as backend.
     It follows the same interface as the CharRNN
     """
 
-    def __init__(self, fasttextmodel: fasttext.FastText):
+    def __init__(
+        self,
+        fasttextmodel: Union["fasttext.FastText._FastText", FastTextSubwords],
+        embedding_size: Optional[int] = None,
+    ):
+        """
+        If `fasttextmodel` is a `FastTextSubwords`, there are no FastText embeddings to start
+        from, so the embeddings are left uninitialized, for loading the parameters of a saved
+        model, and `embedding_size` must be given.
+        """
         super(FastTextTorch, self).__init__()
         self.fasttextmodel = fasttextmodel
-        weights = torch.from_numpy(fasttextmodel.get_input_matrix())
-        # Note: `vocab_size` is the size of the actual fasttext vocabulary. In pratice, the
-        # embeddings here have two more tokens in their vocabulary: one for padding (embedding fixed
-        # at 0, since the padding embedding never receive gradient in `nn.Embedding`) and one for
-        # the special (root) tokens, with values sampled accross the vocabulary
-        self.vocab_size, self.embedding_size = weights.shape
-        root_embedding = weights[
-            torch.randint(high=self.vocab_size, size=(self.embedding_size,)),
-            torch.arange(self.embedding_size),
-        ].unsqueeze(0)
-        weights = torch.cat(
-            (weights, torch.zeros((1, self.embedding_size)), root_embedding), dim=0
-        ).to(torch.float)
+        if isinstance(fasttextmodel, FastTextSubwords):
+            if embedding_size is None:
+                raise ValueError("The embedding size is needed without FastText model")
+            self.vocab_size = fasttextmodel.vocab_size
+            self.embedding_size = embedding_size
+            weights = torch.empty((self.vocab_size + 2, self.embedding_size))
+        else:
+            weights = torch.from_numpy(fasttextmodel.get_input_matrix())
+            # Note: `vocab_size` is the size of the actual fasttext vocabulary. In pratice, the
+            # embeddings here have two more tokens in their vocabulary: one for padding
+            # (embedding fixed at 0, since the padding embedding never receive gradient in
+            # `nn.Embedding`) and one for the special (root) tokens, with values sampled
+            # accross the vocabulary
+            self.vocab_size, self.embedding_size = weights.shape
+            root_embedding = weights[
+                torch.randint(high=self.vocab_size, size=(self.embedding_size,)),
+                torch.arange(self.embedding_size),
+            ].unsqueeze(0)
+            weights = torch.cat(
+                (weights, torch.zeros((1, self.embedding_size)), root_embedding), dim=0
+            ).to(torch.float)
         weights.requires_grad = True
         self.embeddings = nn.Embedding.from_pretrained(
             weights, padding_idx=self.vocab_size + 1
@@ -244,8 +353,16 @@ class FastTextTorch(nn.Module):
         :param tok_sequence:
         :return:
         """
+        if isinstance(self.fasttextmodel, FastTextSubwords):
+            return self.fasttextmodel.subwords_idxes(token)
         return torch.from_numpy(self.fasttextmodel.get_subwords(token)[1])
 
+    def subwords(self) -> FastTextSubwords:
+        """The subwords indexing of this model, without the native FastText model."""
+        if isinstance(self.fasttextmodel, FastTextSubwords):
+            return self.fasttextmodel
+        return FastTextSubwords.from_fasttext(self.fasttextmodel)
+
     def forward(self, xinput: torch.Tensor) -> torch.Tensor:
         """
         :param xinput: a batch of subwords
@@ -257,6 +374,8 @@ class FastTextTorch(nn.Module):
 
     @classmethod
     def loadmodel(cls, modelfile: str) -> "FastTextTorch":
+        import fasttext
+
         return cls(fasttext.load_model(modelfile))
 
     @classmethod
@@ -273,6 +392,8 @@ class FastTextTorch(nn.Module):
                     file=source_stream,
                 )
 
+            import fasttext
+
             print("Training fasttext model...")
             # TODO: make the hyperparameters here configurable
             model = fasttext.train_unsupervised(
@@ -288,6 +409,8 @@ class FastTextTorch(nn.Module):
         if os.path.exists(target_file):
             raise ValueError(f"{target_file} already exists!")
         else:
+            import fasttext
+
             print("Training fasttext model...")
             # TODO: make the hyperparameters here configurable
             model = fasttext.train_unsupervised(
@@ -391,13 +514,27 @@ T = TypeVar("T", bound="BertLexerBatch")
 
 class BertLexerBatch(NamedTuple):
     word_indices: torch.Tensor
-    bert_encoding: BatchEncoding
+    bert_encoding: "BatchEncoding"
     subword_alignments: Sequence[Sequence[TokenSpan]]
 
-    def to(self: T, device: Union[str, torch.device]) -> T:
+    def to(self: T, device: Union[str, torch.device], non_blocking: bool = False) -> T:
+        return type(self)(
+            self.word_indices.to(device=device, non_blocking=non_blocking),
+            type(self.bert_encoding)(
+                {
+                    key: value.to(device=device, non_blocking=non_blocking)
+                    for key, value in self.bert_encoding.items()
+                }
+            ),
+            self.subword_alignments,
+        )
+
+    def pin_memory(self: T) -> T:
         return type(self)(
-            self.word_indices.to(device=device),
-            self.bert_encoding.to(device=device),
+            self.word_indices.pin_memory(),
+            type(self.bert_encoding)(
+                {key: value.pin_memory() for key, value in self.bert_encoding.items()}
+            ),
             self.subword_alignments,
         )
 
@@ -407,7 +544,7 @@ class BertLexerBatch(NamedTuple):
 
 class BertLexerSentence(NamedTuple):
     word_indices: Sequence[int]
-    bert_encoding: BatchEncoding
+    bert_encoding: "BatchEncoding"
     subwords_alignments: Sequence[TokenSpan]
 
 
@@ -460,18 +597,22 @@ class BertBaseLexer(nn.Module):
         words_padding_idx: int,
     ):
 
+        import transformers
+
         super(BertBaseLexer, self).__init__()
         self.itos = itos
         self.stoi = {token: idx for idx, token in enumerate(self.itos)}
         self.unk_word_idx = self.stoi[unk_word]
 
-        self.bert = AutoModel.from_pretrained(bert_modelfile, output_hidden_states=True)
-        self.bert_tokenizer = AutoTokenizer.from_pretrained(
+        self.bert = transformers.AutoModel.from_pretrained(
+            bert_modelfile, output_hidden_states=True
+        )
+        self.bert_tokenizer = transformers.AutoTokenizer.from_pretrained(
             bert_modelfile, use_fast=True
         )
         # Shim for the weird idiosyncrasies of the RoBERTa tokenizer
         if isinstance(self.bert_tokenizer, transformers.GPT2TokenizerFast):
-            self.bert_tokenizer = AutoTokenizer.from_pretrained(
+            self.bert_tokenizer = transformers.AutoTokenizer.from_pretrained(
                 bert_modelfile, use_fast=True, add_prefix_space=True
             )
 
@@ -514,6 +655,23 @@ class BertBaseLexer(nn.Module):
             requires_grad=self.bert_weighted,
         )
 
+    def enable_gradient_checkpointing(self):
+        """Recompute the activations of the BERT model during the backward passes instead of
+        keeping them, if it supports it."""
+        if hasattr(self.bert, "gradient_checkpointing_enable"):
+            if getattr(self.bert, "supports_gradient_checkpointing", False):
+                self.bert.gradient_checkpointing_enable()
+                return
+        elif hasattr(self.bert.config, "gradient_checkpointing"):
+            # transformers < 4.11, where only the configurations of the models that support it
+            # have this attribute
+            self.bert.config.gradient_checkpointing = True
+            return
+        warnings.warn(
+            f"{type(self.bert).__name__} doesn't support gradient checkpointing,"
+            " its activations will be kept"
+        )
+
     def train(self, mode: bool = True) -> "BertBaseLexer":
         if mode:
             self._dpout = self.word_dropout
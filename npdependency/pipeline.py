@@ -0,0 +1,372 @@
+"""Tools for overlapping the data preparation with the computations."""
+import queue
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+# The parsing pipeline only handles the datasets and batches, so this module doesn't import
+# torch and can be used without it
+if TYPE_CHECKING:
+    import numpy as np
+
+    from npdependency.deptree import CompactDepGraph, DependencyBatch, DependencyDataset
+
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+
+class StageStats:
+    """Activity of a pipeline stage: the time spent working on items and the number of items
+    waiting in its queue (sampled every time an item goes through it)."""
+
+    def __init__(self):
+        self.busy_time = 0.0
+        self.items = 0
+        self.max_queue_depth = 0
+        self._total_queue_depth = 0
+        self._queue_samples = 0
+
+    def add_busy(self, busy_time: float):
+        self.busy_time += busy_time
+        self.items += 1
+
+    def sample_queue(self, depth: int):
+        self._total_queue_depth += depth
+        self._queue_samples += 1
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def update(self, other: "StageStats"):
+        """Add the activity recorded by `other` to this one."""
+        self.busy_time += other.busy_time
+        self.items += other.items
+        self.max_queue_depth = max(self.max_queue_depth, other.max_queue_depth)
+        self._total_queue_depth += other._total_queue_depth
+        self._queue_samples += other._queue_samples
+
+    @property
+    def mean_queue_depth(self) -> float:
+        if not self._queue_samples:
+            return 0.0
+        return self._total_queue_depth / self._queue_samples
+
+    def __str__(self):
+        res = f"busy {self.busy_time:.2f}s for {self.items} items"
+        if self._queue_samples:
+            res = f"{res}, queue depth mean {self.mean_queue_depth:.2f} max {self.max_queue_depth}"
+        return res
+
+
+class PipelineStats:
+    """The `StageStats` of the stages of a pipeline, by name."""
+
+    def __init__(self, *stage_names: str):
+        self.stages: Dict[str, StageStats] = {name: StageStats() for name in stage_names}
+
+    def __getitem__(self, stage_name: str) -> StageStats:
+        return self.stages[stage_name]
+
+    def update(self, other: "PipelineStats"):
+        """Add the activity recorded by `other` to this one, stage by stage."""
+        for name, stats in other.stages.items():
+            self.stages.setdefault(name, StageStats()).update(stats)
+
+    def __str__(self):
+        return "\n".join(f"{name}: {stats}" for name, stats in self.stages.items())
+
+
+class _End:
+    pass
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class BackgroundIterator(Generic[T]):
+    """Iterate over an iterable in a background thread.
+
+    Up to `depth` items are prepared in advance (and passed through `transform` if given) while the
+    consumer works on the current one. With `depth=0`, the items are produced synchronously in the
+    consumer thread.
+
+    `wait_time` is the total time the consumer spent waiting for items, which is the time spent
+    producing them in synchronous mode. If `stats` is given, it records the production time of
+    the items and the number of items ready when the consumer asks for one.
+    """
+
+    def __init__(
+        self,
+        iterable: Iterable[U],
+        depth: int,
+        transform: Optional[Callable[[U], T]] = None,
+        stats: Optional[StageStats] = None,
+    ):
+        self.depth = depth
+        self.transform = transform
+        self.stats = stats
+        self.wait_time = 0.0
+        self._stop = threading.Event()
+        self._iterator: Optional[Iterator[U]] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(depth, 1))
+        if depth > 0:
+            self._thread: Optional[threading.Thread] = threading.Thread(
+                target=self._produce, args=(iterable,), daemon=True
+            )
+            self._thread.start()
+        else:
+            self._thread = None
+            self._iterator = iter(iterable)
+
+    def _put(self, item):
+        # Don't block forever if the consumer is gone
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _next_item(self, iterator: Iterator[U]) -> T:
+        start = time.perf_counter()
+        item = next(iterator)
+        res = item if self.transform is None else self.transform(item)
+        if self.stats is not None:
+            self.stats.add_busy(time.perf_counter() - start)
+        return res  # type: ignore
+
+    def _produce(self, iterable: Iterable[U]):
+        iterator = iter(iterable)
+        try:
+            while not self._stop.is_set():
+                self._put(self._next_item(iterator))
+        except StopIteration:
+            self._put(_End())
+        except BaseException as e:
+            self._put(_Failure(e))
+
+    def __iter__(self) -> "BackgroundIterator[T]":
+        return self
+
+    def __next__(self) -> T:
+        start = time.perf_counter()
+        try:
+            if self._iterator is not None:
+                return self._next_item(self._iterator)
+            if self.stats is not None:
+                self.stats.sample_queue(self._queue.qsize())
+            item = self._queue.get()
+        finally:
+            self.wait_time += time.perf_counter() - start
+        if isinstance(item, _End):
+            self._queue.put(item)
+            raise StopIteration
+        elif isinstance(item, _Failure):
+            raise item.exception
+        return item
+
+    def close(self):
+        """Stop the background thread, to be used if the iteration is abandoned."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class BackgroundConsumer(Generic[T]):
+    """Apply a function to items in a background thread, as they are submitted.
+
+    Up to `depth` submitted items wait for the function, after that, `submit` blocks. With
+    `depth=0`, the function is applied synchronously in `submit`. Exceptions raised by the
+    function are raised again by the next call to `submit` or `close`.
+
+    If `stats` is given, it records the time spent in the function and the number of items
+    waiting when a new one is submitted.
+    """
+
+    def __init__(
+        self,
+        function: Callable[[T], Any],
+        depth: int,
+        stats: Optional[StageStats] = None,
+    ):
+        self.function = function
+        self.depth = depth
+        self.stats = stats
+        self._failure: Optional[BaseException] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(depth, 1))
+        if depth > 0:
+            self._thread: Optional[threading.Thread] = threading.Thread(
+                target=self._consume, daemon=True
+            )
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def _apply(self, item: T):
+        start = time.perf_counter()
+        self.function(item)
+        if self.stats is not None:
+            self.stats.add_busy(time.perf_counter() - start)
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, _End):
+                return
+            try:
+                self._apply(item)
+            except BaseException as e:
+                self._failure = e
+                return
+
+    def _check(self):
+        if self._failure is not None:
+            raise self._failure
+
+    def _put(self, item):
+        while True:
+            self._check()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def submit(self, item: T):
+        if self._thread is None:
+            self._apply(item)
+            return
+        if self.stats is not None:
+            self.stats.sample_queue(self._queue.qsize())
+        self._put(item)
+
+    def close(self):
+        """Wait for all the submitted items to be processed."""
+        if self._thread is not None:
+            self._put(_End())
+            self._thread.join()
+        self._check()
+
+    def abandon(self):
+        """Stop the background thread without processing the items still waiting, to be used if
+        the submissions are abandoned (does nothing after `close`). The exceptions raised by the
+        function are not raised again."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        # Only the submitting thread puts items, so there is room for the end once drained
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(_End())
+        self._thread.join()
+
+
+class OrderedSink(Generic[T]):
+    """Pass items that are produced out of order to `sink` in order, by runs of consecutive items
+    as soon as they are available.
+
+    Items are identified by their position, starting at `0`.
+    """
+
+    def __init__(self, sink: Callable[[List[T]], Any]):
+        self.sink = sink
+        # Items that can't be passed to the sink yet because a previous one is missing
+        self.pending: Dict[int, T] = dict()
+        self.next_position = 0
+
+    def put(self, items: Iterable[Tuple[int, T]]):
+        """Add `(position, item)` pairs and pass the items that are now in order to the sink."""
+        self.pending.update(items)
+        ready = []
+        while self.next_position in self.pending:
+            ready.append(self.pending.pop(self.next_position))
+            self.next_position += 1
+        if ready:
+            self.sink(ready)
+
+
+def parse_dataset(
+    test_set: "DependencyDataset",
+    batch_size: int,
+    model: Callable[["DependencyBatch"], Tuple["np.ndarray", "np.ndarray", "np.ndarray"]],
+    sink: Callable[[List["CompactDepGraph"]], Any],
+    greedy: bool = False,
+    order_by_length: bool = False,
+    data_prefetch: int = 2,
+    decode_queue: int = 2,
+    batch_transform: Optional[Callable[["DependencyBatch"], "DependencyBatch"]] = None,
+    stats: Optional[PipelineStats] = None,
+) -> PipelineStats:
+    """Parse a dataset with `model` and pass the parsed trees to `sink` in the dataset order, by
+    runs of consecutive trees as soon as they are available.
+
+    `model` runs a parser on a batch and returns the arrays that `DependencyBatch.parsed_trees`
+    decodes: the best tag of every token, the arc scores and the best label of every arc. The
+    batches are prepared by the `"batching"` stage (and passed through `batch_transform` if
+    given), `model` is the `"model"` stage and the decoding is the `"decoding"` stage, see
+    `BiAffineParser.parse` for the details.
+    """
+    if stats is None:
+        stats = PipelineStats("batching", "model", "decoding")
+    batches = BackgroundIterator(
+        test_set.make_batches(
+            batch_size,
+            shuffle_batches=False,
+            shuffle_data=False,
+            order_by_length=order_by_length,
+        ),
+        data_prefetch,
+        transform=batch_transform if data_prefetch > 0 else None,
+        stats=stats["batching"],
+    )
+
+    # Position of the source trees in the dataset, by identity, so we can restore the natural
+    # order
+    positions = {id(tree): i for i, tree in enumerate(test_set.treelist)}
+    ordered_sink: OrderedSink["CompactDepGraph"] = OrderedSink(sink)
+
+    def decode(
+        outputs: Tuple["DependencyBatch", "np.ndarray", "np.ndarray", "np.ndarray"]
+    ):
+        batch, tag_ids, arc_scores, best_labels = outputs
+        parsed = batch.parsed_trees(
+            tag_ids,
+            arc_scores,
+            best_labels,
+            test_set.itolab,
+            test_set.itotag,
+            greedy=greedy,
+        )
+        ordered_sink.put(
+            (positions[id(tree)], parsed_tree)
+            for tree, parsed_tree in zip(batch.trees, parsed)
+        )
+
+    decoder = BackgroundConsumer(decode, decode_queue, stats=stats["decoding"])
+    try:
+        for batch in batches:
+            start = time.perf_counter()
+            tag_ids, arc_scores, best_labels = model(batch)
+            stats["model"].add_busy(time.perf_counter() - start)
+            decoder.submit((batch, tag_ids, arc_scores, best_labels))
+        decoder.close()
+    finally:
+        batches.close()
+        # Stops the decoding thread if the parsing failed
+        decoder.abandon()
+    return stats
@@ -0,0 +1,319 @@
+"""TorchScript export of the parsers that don't use BERT and parsing with the exported models.
+
+An exported model is a single file that embeds the vocabularies, so parsing with it needs
+neither the configuration and the side files of the model nor `transformers` and the native
+FastText library.
+"""
+import argparse
+import json
+import os.path
+import sys
+import time
+from typing import Any, Callable, List, Optional, Sequence, TextIO, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
+
+from npdependency.deptree import (
+    CompactDepGraph,
+    DepGraph,
+    DependencyBatch,
+    DependencyDataset,
+    parsed_output_paths,
+    read_conll_trees,
+    write_conll,
+)
+from npdependency.lexers import CharDataSet, FastTextDataSet, FastTextSubwords
+from npdependency.pipeline import PipelineStats, parse_dataset
+
+# The name of the file that holds the vocabularies in the TorchScript archive
+METADATA_FILE = "npdependency.json"
+# Increase this when the layout of the exported models changes
+FORMAT_VERSION = 1
+
+
+class ScriptableParser(nn.Module):
+    """The network of a `BiAffineParser` with a `DefaultLexer`, in a form that TorchScript can
+    compile, for inference only.
+
+    It shares its parameters with the parser it is built from and returns what the decoding
+    needs: the predicted tags, the arc scores and the best label of every arc.
+    """
+
+    def __init__(self, parser):
+        super().__init__()
+        self.word_embedding = parser.lexer.embedding
+        self.char_rnn = parser.char_rnn
+        self.ft_embedding = parser.ft_lexer.embeddings
+        self.dep_rnn = parser.dep_rnn
+        self.mlps = parser.mlps
+        self.arc_biaffine = parser.arc_biaffine
+        self.lab_biaffine = parser.lab_biaffine
+
+    def forward(
+        self,
+        words: torch.Tensor,
+        chars: List[torch.Tensor],
+        subwords: List[torch.Tensor],
+        sent_lengths: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        char_embed = torch.stack([self.char_rnn(column) for column in chars], dim=1)
+        # The padding embedding is 0, see `FastTextTorch.forward`
+        ft_embed = torch.stack(
+            [self.ft_embedding(column).mean(dim=1) for column in subwords], dim=1
+        )
+        lex_emb = self.word_embedding(words)
+
+        xinput = torch.cat((lex_emb, char_embed, ft_embed), dim=2)
+        packed_xinput = pack_padded_sequence(
+            xinput, sent_lengths, batch_first=True, enforce_sorted=False
+        )
+        packed_dep_embeddings, _ = self.dep_rnn(packed_xinput)
+        dep_embeddings, _ = pad_packed_sequence(packed_dep_embeddings, batch_first=True)
+
+        tag_scores, arc_h, arc_d, lab_h, lab_d = self.mlps(dep_embeddings)
+        tag_ids = tag_scores.argmax(dim=-1)
+        arc_scores = self.arc_biaffine(arc_h, arc_d).squeeze(1)
+        best_labels = self.lab_biaffine(lab_h, lab_d).argmax(dim=1)
+        return tag_ids, arc_scores, best_labels
+
+
+def export(parser, path: str, batch_size: int):
+    """Save a parser with a `DefaultLexer` as a TorchScript model at `path`.
+
+    `batch_size` is saved as the default batch size for parsing with the exported model.
+    """
+    # Imported here since the graph_parser module is what we want to avoid when loading
+    from npdependency.graph_parser import BiAffineParser
+    from npdependency.lexers import DefaultLexer
+
+    if not isinstance(parser, BiAffineParser) or not isinstance(
+        parser.lexer, DefaultLexer
+    ):
+        raise ValueError("Only the parsers with a default lexer can be exported")
+    if parser.mixed_precision is not None:
+        raise ValueError("Mixed precision parsers can't be exported")
+    parser.eval()
+    scripted = torch.jit.script(ScriptableParser(parser).cpu())
+    metadata = {
+        "format_version": FORMAT_VERSION,
+        "batch_size": batch_size,
+        "vocab": list(parser.lexer.itos),
+        "unk_word": parser.lexer.itos[parser.lexer.unk_word_idx],
+        "charset": parser.charset.i2c[2:],
+        "labels": list(parser.labels),
+        "tags": list(parser.tagset),
+        "fasttext": parser.ft_lexer.subwords().to_dict(),
+    }
+    torch.jit.save(
+        scripted,
+        path,
+        _extra_files={METADATA_FILE: json.dumps(metadata).encode("utf-8")},
+    )
+
+
+class WordIndexer:
+    """The word encoding of a `DefaultLexer`, without its embeddings."""
+
+    def __init__(self, itos: Sequence[str], unk_word: str):
+        self.itos = itos
+        self.stoi = {token: idx for idx, token in enumerate(self.itos)}
+        self.unk_word_idx = self.stoi[unk_word]
+
+    def tokenize(self, tok_sequence: Sequence[str]) -> List[int]:
+        return [self.stoi.get(token, self.unk_word_idx) for token in tok_sequence]
+
+    def pad_batch(self, batch: Sequence[Sequence[int]]) -> torch.Tensor:
+        tensorized_sents = [torch.tensor(sent, dtype=torch.long) for sent in batch]
+        return pad_sequence(
+            tensorized_sents,
+            padding_value=DependencyDataset.PAD_IDX,
+            batch_first=True,
+        )
+
+
+class ScriptedParser:
+    """A parser loaded from a model exported with `export`."""
+
+    def __init__(
+        self, path: str, device: Union[str, torch.device] = "cpu", optimize: bool = True
+    ):
+        """
+        If `optimize` is true, the model is frozen and optimized for inference (this requires
+        torch >= 1.10).
+        """
+        self.device = torch.device(device)
+        extra_files = {METADATA_FILE: ""}
+        self.model = torch.jit.load(
+            path, map_location=self.device, _extra_files=extra_files
+        )
+        self.model.eval()
+        if optimize and hasattr(torch.jit, "optimize_for_inference"):
+            self.model = torch.jit.optimize_for_inference(self.model)
+        metadata = json.loads(extra_files[METADATA_FILE])
+        if metadata["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported exported model version {metadata['format_version']}"
+            )
+        self.batch_size: int = metadata["batch_size"]
+        self.lexer = WordIndexer(metadata["vocab"], metadata["unk_word"])
+        self.charset = CharDataSet(
+            metadata["charset"], special_tokens=[DepGraph.ROOT_TOKEN]
+        )
+        self.ft_subwords = FastTextSubwords(**metadata["fasttext"])
+        self.labels: List[str] = metadata["labels"]
+        self.tagset: List[str] = metadata["tags"]
+
+    def encode_trees(self, trees: List[CompactDepGraph]) -> DependencyDataset:
+        """Encode trees with the vocabularies of this parser, for parsing."""
+        return DependencyDataset(
+            trees,
+            self.lexer,  # type: ignore
+            self.charset,
+            FastTextDataSet(self.ft_subwords, special_tokens=[DepGraph.ROOT_TOKEN]),
+            use_labels=self.labels,
+            use_tags=self.tagset,
+        )
+
+    def parse(
+        self,
+        test_set: DependencyDataset,
+        batch_size: int,
+        sink: Callable[[List[CompactDepGraph]], Any],
+        greedy: bool = False,
+        order_by_length: bool = False,
+        data_prefetch: int = 2,
+        decode_queue: int = 2,
+        stats: Optional[PipelineStats] = None,
+    ) -> PipelineStats:
+        """Parse a dataset and pass the parsed trees to `sink` in the dataset order, by runs of
+        consecutive trees.
+
+        This is the same pipeline as `BiAffineParser.parse`, see `pipeline.parse_dataset`.
+        """
+
+        def run_model(batch: DependencyBatch) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            tag_ids, arc_scores, best_labels = self.model(
+                batch.encoded_words.to(self.device),
+                [column.to(self.device) for column in batch.chars],
+                [column.to(self.device) for column in batch.subwords],
+                batch.sent_lengths,
+            )
+            return tag_ids.cpu().numpy(), arc_scores.cpu().numpy(), best_labels.cpu().numpy()
+
+        with torch.no_grad():
+            return parse_dataset(
+                test_set,
+                batch_size,
+                run_model,
+                sink,
+                greedy=greedy,
+                order_by_length=order_by_length,
+                data_prefetch=data_prefetch,
+                decode_queue=decode_queue,
+                stats=stats,
+            )
+
+    def predict_file(
+        self,
+        istream: TextIO,
+        ostream: TextIO,
+        batch_size: Optional[int] = None,
+        greedy: bool = False,
+        stats: Optional[PipelineStats] = None,
+    ) -> PipelineStats:
+        """Parse a CoNLL-U stream and write the parsed trees to `ostream`."""
+        test_set = self.encode_trees(list(read_conll_trees(istream)))
+
+        def write(trees: List[CompactDepGraph]):
+            write_conll(trees, ostream)
+
+        return self.parse(
+            test_set,
+            batch_size if batch_size is not None else self.batch_size,
+            write,
+            greedy=greedy,
+            stats=stats,
+        )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Export a parser to TorchScript or parse with an exported parser"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser(
+        "export", help="export a trained parser without BERT"
+    )
+    export_parser.add_argument(
+        "config_file", metavar="CONFIG_FILE", help="the configuration file of the model"
+    )
+    export_parser.add_argument(
+        "out_file", metavar="OUT_FILE", help="the path of the exported model"
+    )
+    parse_parser = subparsers.add_parser("parse", help="parse with an exported parser")
+    parse_parser.add_argument(
+        "model_file", metavar="MODEL_FILE", help="the exported model"
+    )
+    parse_parser.add_argument(
+        "pred_files",
+        metavar="PRED_FILE",
+        nargs="+",
+        help="the conll files to parse, use '-' to parse the standard input and write the parses to the standard output",
+    )
+    parse_parser.add_argument(
+        "--out_dir",
+        metavar="OUT_DIR",
+        help="the path of the output directory (defaults to the directory of each file)",
+    )
+    parse_parser.add_argument(
+        "--batch_size",
+        metavar="N",
+        type=int,
+        help="the parsing batch size (defaults to the one of the exported model)",
+    )
+    parse_parser.add_argument(
+        "--device",
+        metavar="DEVICE",
+        default="cpu",
+        help="the (torch) device to use for the parser",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        from npdependency.graph_parser import BiAffineParser, load_hyperparameters
+
+        hp = load_hyperparameters(args.config_file)
+        parsing_model = BiAffineParser.from_config(args.config_file, {"device": "cpu"})
+        export(parsing_model, args.out_file, hp["batch_size"])
+        print(f"Exported the model to {args.out_file}", file=sys.stderr)
+        return
+
+    try:
+        paths = parsed_output_paths(args.pred_files, args.out_dir)
+    except ValueError as e:
+        parse_parser.error(str(e))
+    start = time.perf_counter()
+    scripted_parser = ScriptedParser(args.model_file, device=args.device)
+    print(f"Loaded the model in {time.perf_counter()-start:.2f}s", file=sys.stderr)
+    stats = PipelineStats("batching", "model", "decoding")
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    for pred_file, out_file in paths:
+        if pred_file == "-":
+            scripted_parser.predict_file(
+                sys.stdin, sys.stdout, batch_size=args.batch_size, stats=stats
+            )
+            continue
+        with open(pred_file) as istream, open(out_file, "w") as ostream:
+            scripted_parser.predict_file(
+                istream, ostream, batch_size=args.batch_size, stats=stats
+            )
+    print("parsing done.", file=sys.stderr)
+    print(f"Parsing pipeline activity:\n{stats}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
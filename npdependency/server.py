@@ -0,0 +1,442 @@
+"""A parsing server that keeps a model loaded between requests.
+
+Start it with `graph_parser serve MODEL/params.yaml` and POST sentences to `/parse`, either as
+CoNLL-U (the response is CoNLL-U too) or as JSON (`Content-Type: application/json`) with the
+format
+
+```json
+{"sentences": [["Flaubert", "a", "écrit", "Madame", "Bovary", "."]]}
+```
+
+in which case the response is
+
+```json
+{"sentences": [{"words": […], "tags": […], "heads": […], "labels": […]}]}
+```
+
+where `heads[i]` is the (1-based, `0` for the root) governor of `words[i]`.
+
+The sentences of concurrent requests are parsed together (see `MicroBatcher`), `GET /stats`
+returns latency and batch size histograms to tune this.
+"""
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import http.server
+import io
+import json
+import os
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from npdependency.deptree import (
+    CompactDepGraph,
+    DependencyDataset,
+    DepGraph,
+    read_conll_trees,
+    write_conll,
+)
+from npdependency.graph_parser import BiAffineParser, load_hyperparameters
+from npdependency.lexers import FastTextDataSet
+
+
+class ParsingService:
+    """A resident parser, that parses lists of trees one request at a time."""
+
+    def __init__(self, parser: BiAffineParser, batch_size: int):
+        self.parser = parser
+        self.parser.eval()
+        self.batch_size = batch_size
+        # FIXME: the special tokens should be saved somewhere instead of hardcoded
+        self.ft_dataset = FastTextDataSet(
+            self.parser.ft_lexer, special_tokens=[DepGraph.ROOT_TOKEN]
+        )
+        self._lock = threading.Lock()
+
+    def parse(self, trees: List[CompactDepGraph]) -> List[CompactDepGraph]:
+        dataset = DependencyDataset(
+            trees,
+            self.parser.lexer,
+            self.parser.charset,
+            self.ft_dataset,
+            use_labels=self.parser.labels,
+            use_tags=self.parser.tagset,
+        )
+        parsed: List[CompactDepGraph] = []
+        # Requests are small: running the pipeline stages synchronously avoids spawning threads
+        with self._lock:
+            self.parser.parse(
+                dataset,
+                self.batch_size,
+                parsed.extend,
+                order_by_length=True,
+                data_prefetch=0,
+                decode_queue=0,
+            )
+        return parsed
+
+
+class Histogram:
+    """Counts of values in buckets with fixed upper bounds."""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def to_dict(self) -> Dict[str, Any]:
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            "buckets": {
+                **{f"<={bound:g}": n for bound, n in zip(self.bounds, self.counts)},
+                "+inf": self.counts[-1],
+            },
+        }
+
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class _PendingRequest(NamedTuple):
+    trees: List[CompactDepGraph]
+    result: "asyncio.Future[List[CompactDepGraph]]"
+    arrival: float
+
+
+class MicroBatcher:
+    """Gather the sentences of concurrent requests into larger batches.
+
+    A request waits at most `max_latency` seconds for others to join it, unless the pending
+    requests reach `max_sentences` sentences or `max_tokens` tokens before, then all the pending
+    requests are parsed together and the parses are routed back to their request.
+
+    The requests are gathered by an asyncio event loop running in a background thread, the
+    parsing itself runs in another thread so that the next batch can be gathered meanwhile.
+    `parse` is safe to call from any thread.
+    """
+
+    def __init__(
+        self,
+        service: ParsingService,
+        max_latency: float,
+        max_sentences: int,
+        max_tokens: int,
+    ):
+        self.service = service
+        self.max_latency = max_latency
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        # Time from reception to response of the requests
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+        # Time from reception to the start of the parsing of their batch
+        self.queue_time = Histogram(LATENCY_BUCKETS_MS)
+        self.batch_sentences = Histogram(SIZE_BUCKETS)
+        self.batch_tokens = Histogram(SIZE_BUCKETS)
+
+        self._pending: List[_PendingRequest] = []
+        self._pending_sentences = 0
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batches: Set["asyncio.Task[None]"] = set()
+        # One worker since the parser runs one batch at a time anyway
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def parse(self, trees: List[CompactDepGraph]) -> List[CompactDepGraph]:
+        return asyncio.run_coroutine_threadsafe(
+            self._parse(trees), self.loop
+        ).result()
+
+    def stats(self) -> Dict[str, Any]:
+        return asyncio.run_coroutine_threadsafe(self._stats(), self.loop).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._executor.shutdown()
+
+    async def _stats(self) -> Dict[str, Any]:
+        return {
+            "latency_ms": self.latency.to_dict(),
+            "queue_time_ms": self.queue_time.to_dict(),
+            "batch_sentences": self.batch_sentences.to_dict(),
+            "batch_tokens": self.batch_tokens.to_dict(),
+        }
+
+    async def _parse(self, trees: List[CompactDepGraph]) -> List[CompactDepGraph]:
+        arrival = time.perf_counter()
+        result = self.loop.create_future()
+        self._pending.append(_PendingRequest(trees, result, arrival))
+        self._pending_sentences += len(trees)
+        self._pending_tokens += sum(len(tree) - 1 for tree in trees)
+        if (
+            self._pending_sentences >= self.max_sentences
+            or self._pending_tokens >= self.max_tokens
+        ):
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.max_latency, self._flush)
+        parsed = await result
+        self.latency.add(1000 * (time.perf_counter() - arrival))
+        return parsed
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        requests = self._pending
+        self._pending = []
+        self._pending_sentences = 0
+        self._pending_tokens = 0
+        # Keep a reference to the task so that it isn't garbage collected before it's done
+        batch = self.loop.create_task(self._run_batch(requests))
+        self._batches.add(batch)
+        batch.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, requests: List[_PendingRequest]):
+        trees = [tree for request in requests for tree in request.trees]
+        self.batch_sentences.add(len(trees))
+        self.batch_tokens.add(sum(len(tree) - 1 for tree in trees))
+
+        def run() -> Tuple[float, List[CompactDepGraph]]:
+            return time.perf_counter(), self.service.parse(trees)
+
+        try:
+            start, parsed = await self.loop.run_in_executor(self._executor, run)
+        except Exception as e:
+            for request in requests:
+                request.result.set_exception(e)
+            return
+        offset = 0
+        for request in requests:
+            self.queue_time.add(1000 * (start - request.arrival))
+            request.result.set_result(parsed[offset : offset + len(request.trees)])
+            offset += len(request.trees)
+
+
+def trees_from_json(document: Any) -> List[CompactDepGraph]:
+    """Read the trees of a JSON request, raising a `ValueError` if it is malformed."""
+    if not isinstance(document, dict) or not isinstance(
+        document.get("sentences"), list
+    ):
+        raise ValueError('Expected an object with a "sentences" list')
+    trees = []
+    for sentence in document["sentences"]:
+        if (
+            not isinstance(sentence, list)
+            or not sentence
+            or not all(isinstance(word, str) for word in sentence)
+        ):
+            raise ValueError("Sentences must be non-empty lists of strings")
+        trees.append(
+            CompactDepGraph(
+                [DepGraph.ROOT_TOKEN, *sentence],
+                [0] * (len(sentence) + 1),
+                ["_"] * (len(sentence) + 1),
+            )
+        )
+    return trees
+
+
+def trees_to_json(trees: Sequence[CompactDepGraph]) -> Dict[str, Any]:
+    return {
+        "sentences": [
+            {
+                "words": tree.words[1:],
+                "tags": tree.pos_tags[1:],
+                "heads": tree.heads[1:].tolist(),
+                "labels": tree.labels[1:],
+            }
+            for tree in trees
+        ]
+    }
+
+
+class ParsingRequestHandler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, *args, batcher: MicroBatcher, **kwargs):
+        # This has to be set before calling the parent constructor, which handles the request
+        self.batcher = batcher
+        super().__init__(*args, **kwargs)
+
+    def address_string(self) -> str:
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "local"
+
+    def send_body(self, code: int, body: str, content_type: str):
+        encoded = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404, "Only /stats is available with GET")
+            return
+        self.send_body(200, json.dumps(self.batcher.stats()), "application/json")
+
+    def do_POST(self):
+        if self.path != "/parse":
+            self.send_error(404, "Parse requests should be sent to /parse")
+            return
+        if "Content-Length" not in self.headers:
+            self.send_error(411, "Parse requests need a Content-Length")
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return
+        as_json = self.headers.get_content_type() == "application/json"
+        try:
+            body = self.rfile.read(length).decode("utf-8")
+            if as_json:
+                trees = trees_from_json(json.loads(body))
+            else:
+                trees = list(read_conll_trees(io.StringIO(body)))
+        except ValueError as e:
+            self.send_error(400, f"Invalid request: {e}")
+            return
+        try:
+            parsed = self.batcher.parse(trees) if trees else []
+            if as_json:
+                body = json.dumps(trees_to_json(parsed), ensure_ascii=False)
+            else:
+                output = io.StringIO()
+                write_conll(parsed, output)
+                body = output.getvalue()
+        except Exception as e:
+            self.log_error("Parsing failed: %r", e)
+            traceback.print_exc(file=sys.stderr)
+            self.send_error(500, "Parsing failed")
+            return
+        self.send_body(200, body, "application/json" if as_json else "text/plain")
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def make_server(
+    batcher: MicroBatcher,
+    host: str = "localhost",
+    port: int = 8000,
+    socket_path: Optional[str] = None,
+) -> socketserver.BaseServer:
+    """Make a server that listens on `socket_path` if it is given, on `host:port` otherwise."""
+
+    def handler(*args, **kwargs):
+        return ParsingRequestHandler(*args, batcher=batcher, **kwargs)
+
+    if socket_path is None:
+        return http.server.ThreadingHTTPServer((host, port), handler)
+    # Remove the socket left by a previous server, but nothing else
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            raise ValueError(f"{socket_path} exists and is not a socket")
+        os.remove(socket_path)
+    return ThreadingUnixHTTPServer(socket_path, handler)
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="graph_parser serve",
+        description="Serve a trained parser over HTTP",
+    )
+    parser.add_argument(
+        "config_file", metavar="CONFIG_FILE", type=str, help="the configuration file"
+    )
+    parser.add_argument("--host", default="localhost", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="the port to listen on")
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        type=str,
+        help="listen on a Unix socket at PATH instead of a TCP port",
+    )
+    parser.add_argument(
+        "--device",
+        metavar="DEVICE",
+        type=str,
+        help="the (torch) device to use for the parser. Supersedes configuration if given",
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["dynamic"],
+        help="quantize the model for parsing on CPU, 'dynamic' quantizes the LSTM and linear weights to int8",
+    )
+    parser.add_argument(
+        "--batch_size",
+        metavar="N",
+        type=int,
+        help="the batch size for parsing (defaults to the one in the configuration), requests are parsed as soon as they add up to this many sentences",
+    )
+    parser.add_argument(
+        "--max_latency",
+        metavar="MS",
+        type=float,
+        default=10.0,
+        help="the maximum time a request waits for others to be parsed with it, in milliseconds",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        metavar="N",
+        type=int,
+        default=4096,
+        help="requests are parsed as soon as they add up to this many tokens",
+    )
+    args = parser.parse_args(argv)
+
+    overrides: Dict[str, Any] = dict()
+    if args.device is not None:
+        overrides["device"] = args.device
+    if args.quantize is not None:
+        overrides["quantize"] = args.quantize
+    biaffine_parser = BiAffineParser.from_config(args.config_file, overrides)
+    if args.batch_size is not None:
+        batch_size = args.batch_size
+    else:
+        batch_size = load_hyperparameters(args.config_file)["batch_size"]
+    batcher = MicroBatcher(
+        ParsingService(biaffine_parser, batch_size),
+        max_latency=args.max_latency / 1000,
+        max_sentences=batch_size,
+        max_tokens=args.max_tokens,
+    )
+    server = make_server(batcher, args.host, args.port, socket_path=args.socket)
+    address = args.socket if args.socket is not None else f"http://{args.host}:{args.port}"
+    print(f"Serving {args.config_file} on {address}", file=sys.stderr)
+    # Make sure that the socket is cleaned up when we are asked to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket is not None:
+            os.remove(args.socket)